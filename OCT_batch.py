@@ -0,0 +1,234 @@
+"""
+Convert all OCT files of a directory tree with a pool of worker processes.
+
+Usage:
+python OCT_batch.py <directory> --format npy --workers 4
+python OCT_batch.py <directory> --format mat73 --watch --interval 10 --max-queue 16
+
+The progress is recorded per file and format in the manifest <directory>/OCT_batch.json, so a rerun skips all files
+whose outputs of that format are up to date (same size and modification time of the OCT file and the output exists).
+--watch keeps polling the directory for new acquisitions. A file is converted when its size and
+modification time did not change between two polls. At most --max-queue files are pending at a time;
+further files are picked up when the queue drains.
+
+Formats:
+npy       OCTtoMATraw -> <name>.npy
+npystream OCTtoNPYstream -> <name>_npy/
+mat73     OCTtoMAT73 -> <name>.mat
+log       OCTtoLogNPY (uint8 log10 intensity) -> <name>_log/
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import re
+import time
+
+output_formats = {
+    'npy': lambda base: base + '.npy',
+    'npystream': lambda base: base + '_npy',
+    'mat73': lambda base: base + '.mat',
+    'log': lambda base: base + '_log',
+}
+
+def get_OCTOutputName(oct_filename, output_format):
+    """
+    Return the file or folder name the converter for output_format writes for oct_filename.
+    """
+    return output_formats[output_format](re.split(r'\.[oO][cC][tT]', oct_filename)[0])
+
+def convert_OCTFile(oct_filename, output_format='npy'):
+    """
+    Convert one OCT file with the converter of output_format and return the output name.
+    The progress messages of the converter are discarded.
+    """
+    import OCT_converter
+    with contextlib.redirect_stdout(io.StringIO()):
+        if output_format == 'npy':
+            OCT_converter.OCTtoMATraw(oct_filename)
+        elif output_format == 'npystream':
+            OCT_converter.OCTtoNPYstream(oct_filename)
+        elif output_format == 'mat73':
+            OCT_converter.OCTtoMAT73(oct_filename)
+        elif output_format == 'log':
+            OCT_converter.OCTtoLogNPY(oct_filename)
+        else:
+            raise ValueError('Unknown output format {}'.format(output_format))
+    return get_OCTOutputName(oct_filename, output_format)
+
+def _convert_task(oct_filename, output_format):
+    """
+    Run convert_OCTFile in a worker process and return the manifest entry.
+    """
+    t0 = time.perf_counter()
+    try:
+        output = convert_OCTFile(oct_filename, output_format)
+        entry = {'status': 'done', 'output': output}
+    except Exception as e:
+        entry = {'status': 'failed', 'error': '{}: {}'.format(type(e).__name__, e)}
+    entry['seconds'] = time.perf_counter() - t0
+    return entry
+
+def find_OCTFiles(directory):
+    """
+    Return the sorted paths of all .oct files below directory.
+    """
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        found += [os.path.join(root, f) for f in sorted(files) if f.lower().endswith('.oct')]
+    return found
+
+def get_FileStamp(filename):
+    """
+    Return (size, mtime_ns) of filename to detect changed files.
+    """
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+class OCTManifest:
+    """
+    Conversion state of all OCT files of a directory, stored as JSON keyed by the relative path and the output format,
+    so the conversions to different formats do not replace each other.
+    Each save writes a temporary file and renames it, so an interrupted run leaves a valid manifest.
+    """
+    def __init__(self, directory, filename=None):
+        self.directory = directory
+        self.filename = filename or os.path.join(directory, 'OCT_batch.json')
+        self.entries = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as fid:
+                self.entries = json.load(fid)
+        for key, entry in self.entries.items():
+            if 'status' in entry:
+                # manifests with one entry per file
+                self.entries[key] = {entry.pop('format'): entry}
+
+    def key(self, oct_filename):
+        return os.path.relpath(oct_filename, self.directory).replace(os.sep, '/')
+
+    def is_up_to_date(self, oct_filename, output_format, retry_failed=True):
+        """
+        True if oct_filename was converted to output_format and neither the OCT file changed nor the output was removed.
+        With retry_failed=False a failed conversion of the unchanged file also counts as up to date.
+        """
+        entry = self.entries.get(self.key(oct_filename), {}).get(output_format)
+        if not entry or entry['stamp'] != get_FileStamp(oct_filename):
+            return False
+        if entry['status'] == 'done':
+            return os.path.exists(os.path.join(self.directory, entry['output']))
+        return entry['status'] == 'failed' and not retry_failed
+
+    def update(self, oct_filename, output_format, stamp, entry):
+        if 'output' in entry:
+            entry = dict(entry, output=self.key(entry['output']))
+        self.entries.setdefault(self.key(oct_filename), {})[output_format] = dict(entry, stamp=stamp)
+        self.save()
+
+    def failed(self, output_format):
+        """
+        The relative paths of the files whose conversion to output_format failed.
+        """
+        return [key for key, formats in self.entries.items()
+                if formats.get(output_format, {}).get('status') == 'failed']
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fid:
+            json.dump(self.entries, fid, indent=1, sort_keys=True)
+        os.replace(tmp, self.filename)
+
+def _collect(futures, manifest, output_format, return_when=concurrent.futures.FIRST_COMPLETED, timeout=None):
+    """
+    Wait for the pending conversions and record the finished ones in the manifest.
+    Cancelled conversions are dropped without an entry.
+    """
+    done, _ = concurrent.futures.wait(futures, timeout=timeout, return_when=return_when)
+    for future in done:
+        oct_filename, stamp = futures.pop(future)
+        if future.cancelled():
+            continue
+        entry = future.result()
+        manifest.update(oct_filename, output_format, stamp, entry)
+        print('{} {} ({:.1f} s){}'.format(entry['status'], oct_filename, entry['seconds'],
+                                          ': ' + entry['error'] if 'error' in entry else ''))
+    return done
+
+def batch_convert(directory, output_format='npy', workers=None, manifest=None):
+    """
+    Convert all OCT files below directory that are not up to date in the manifest
+    using a pool of workers processes (default os.cpu_count()).
+    Returns the manifest.
+    """
+    manifest = manifest or OCTManifest(directory)
+    todo = [f for f in find_OCTFiles(directory) if not manifest.is_up_to_date(f, output_format)]
+    print('{} file(s) to convert'.format(len(todo)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_convert_task, f, output_format): (f, get_FileStamp(f)) for f in todo}
+        while futures:
+            _collect(futures, manifest, output_format, concurrent.futures.FIRST_COMPLETED)
+    return manifest
+
+def watch_convert(directory, output_format='npy', workers=None, interval=10.0, max_queue=16, manifest=None, max_polls=None):
+    """
+    Poll directory every interval seconds and convert new or changed OCT files as they arrive.
+    A file is queued when its size and modification time are the same in two consecutive polls,
+    i.e. the acquisition finished writing it. At most max_queue conversions are pending; while the queue
+    is full the polling waits for conversions to finish (back-pressure). Failed files are retried only if they change.
+    Runs until interrupted or for max_polls polls.
+    """
+    manifest = manifest or OCTManifest(directory)
+    last_seen = {}
+    futures = {}
+    polls = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            while max_polls is None or polls < max_polls:
+                polls += 1
+                t_next = time.monotonic() + interval
+                queued = {f for f, _ in futures.values()}
+                seen = {}
+                for f in find_OCTFiles(directory):
+                    if f in queued or manifest.is_up_to_date(f, output_format, retry_failed=False):
+                        continue
+                    seen[f] = stamp = get_FileStamp(f)
+                    if last_seen.get(f) != stamp:
+                        # new or still being written
+                        continue
+                    while len(futures) >= max_queue:
+                        _collect(futures, manifest, output_format)
+                    futures[pool.submit(_convert_task, f, output_format)] = (f, stamp)
+                last_seen = seen
+                # record finished conversions until the next poll
+                while futures and time.monotonic() < t_next:
+                    _collect(futures, manifest, output_format, timeout=t_next - time.monotonic())
+                if max_polls is None or polls < max_polls:
+                    time.sleep(max(0.0, t_next - time.monotonic()))
+        except KeyboardInterrupt:
+            print('Stopping; waiting for the running conversion(s)')
+            for future in futures:
+                future.cancel()
+        while futures:
+            _collect(futures, manifest, output_format, concurrent.futures.ALL_COMPLETED)
+    return manifest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory')
+    parser.add_argument('--format', default='npy', choices=sorted(output_formats))
+    parser.add_argument('--workers', type=int, default=None, help='default: number of CPUs')
+    parser.add_argument('--manifest', default=None, help='default: <directory>/OCT_batch.json')
+    parser.add_argument('--watch', action='store_true', help='keep converting new files as they arrive')
+    parser.add_argument('--interval', type=float, default=10.0, help='seconds between polls in watch mode')
+    parser.add_argument('--max-queue', type=int, default=16, help='maximum number of pending files in watch mode')
+    args = parser.parse_args()
+    manifest = OCTManifest(args.directory, args.manifest)
+    if args.watch:
+        watch_convert(args.directory, args.format, args.workers, args.interval, args.max_queue, manifest)
+    else:
+        manifest = batch_convert(args.directory, args.format, args.workers, manifest)
+        failed = manifest.failed(args.format)
+        if failed:
+            raise SystemExit('{} file(s) failed: {}'.format(len(failed), ', '.join(failed)))
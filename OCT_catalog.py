@@ -0,0 +1,200 @@
+"""
+A SQLite catalog of the headers of OCT files to find scans without extracting them.
+
+Only Header.xml is read from each archive. The catalog stores per file the path, size, modification time,
+Instrument Model, AcquisitionMode, SizeX/SizeY/SizeZ, RefractiveIndex, MetaInfo Comment,
+the list of data files and the complete header as JSON.
+Updates are incremental: only new or changed files (size or modification time) are read again
+and files that were removed are deleted from the catalog.
+
+Usage:
+python OCT_catalog.py catalog.sqlite update <directory> --workers 8
+python OCT_catalog.py catalog.sqlite query --model TEL220C1 --acquisition-mode Mode3D --comment wedge
+
+Testing and usage example:
+
+import OCT_catalog
+OCT_catalog.update_OCTCatalog('catalog.sqlite', '/data/oct')
+for row in OCT_catalog.query_OCTCatalog('catalog.sqlite', model='TEL220C1', min_size_y=100):
+    print(row['path'], row['comment'])
+"""
+import argparse
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from OCT_core import read_OCTHeader
+
+catalog_columns = ['path', 'size', 'mtime_ns', 'model', 'acquisition_mode', 'size_x', 'size_y', 'size_z',
+                   'refractive_index', 'comment', 'data_files', 'header', 'error']
+
+def open_OCTCatalog(catalog_filename):
+    """
+    Open (and create) the catalog database. Rows are returned as sqlite3.Row.
+    """
+    db = sqlite3.connect(catalog_filename)
+    db.row_factory = sqlite3.Row
+    db.execute('''CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+        model TEXT, acquisition_mode TEXT, size_x INTEGER, size_y INTEGER, size_z INTEGER,
+        refractive_index REAL, comment TEXT, data_files TEXT, header TEXT, error TEXT)''')
+    for column in ['model', 'acquisition_mode']:
+        db.execute('CREATE INDEX IF NOT EXISTS files_{0} ON files ({0})'.format(column))
+    return db
+
+def _get_item(header, *keys):
+    """
+    Return header[key0][key1]... or None if a key is missing.
+    """
+    for key in keys:
+        if not isinstance(header, dict) or key not in header:
+            return None
+        header = header[key]
+    return header
+
+def _to_text(value):
+    """
+    The text of a header element; elements with attributes are dicts with the text in '#text'.
+    """
+    if isinstance(value, dict):
+        value = value.get('#text')
+    return None if value is None else str(value)
+
+def _to_number(value, number_type):
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return None
+
+def _like_escape(text):
+    """
+    Escape the wildcards of LIKE ... ESCAPE '\\'.
+    """
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def get_OCTCatalogEntry(filename):
+    """
+    Read Header.xml of filename and return the catalog row as dict, or None if the file was removed.
+    A file that cannot be read is stored with the error message and without header fields.
+    """
+    entry = dict.fromkeys(catalog_columns)
+    entry['path'] = os.path.abspath(filename)
+    try:
+        st = os.stat(filename)
+        entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+        header = read_OCTHeader(filename)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        entry['error'] = '{}: {}'.format(type(e).__name__, e)
+        return entry
+    ocity = header.get('Ocity', {})
+    data_files = _get_item(ocity, 'DataFiles', 'DataFile') or []
+    if isinstance(data_files, dict):
+        data_files = [data_files]
+    entry.update(
+        model=_to_text(_get_item(ocity, 'Instrument', 'Model')),
+        acquisition_mode=_to_text(_get_item(ocity, 'Acquisition', 'AcquisitionMode')),
+        size_x=_to_number(_to_text(_get_item(ocity, 'Image', 'SizePixel', 'SizeX')), int),
+        size_y=_to_number(_to_text(_get_item(ocity, 'Image', 'SizePixel', 'SizeY')), int),
+        size_z=_to_number(_to_text(_get_item(ocity, 'Image', 'SizePixel', 'SizeZ')), int),
+        refractive_index=_to_number(_to_text(_get_item(ocity, 'Acquisition', 'RefractiveIndex')), float),
+        comment=_to_text(_get_item(ocity, 'MetaInfo', 'Comment')),
+        data_files=json.dumps([data_file.get('#text') for data_file in data_files if isinstance(data_file, dict)]),
+        header=json.dumps(header))
+    return entry
+
+def update_OCTCatalog(catalog_filename, directory, workers=8):
+    """
+    Add all new or changed OCT files below directory to the catalog and remove the deleted ones.
+    The headers are read with workers threads, which hides the latency of network file systems.
+    Returns the number of files (read, removed).
+    """
+    directory = os.path.abspath(directory)
+    db = open_OCTCatalog(catalog_filename)
+    try:
+        known = {row['path']: (row['size'], row['mtime_ns'])
+                 for row in db.execute("SELECT path, size, mtime_ns FROM files WHERE path LIKE ? ESCAPE '\\'",
+                                       (_like_escape(os.path.join(directory, '')) + '%',))}
+        todo = []
+        for root, dirs, files in os.walk(directory):
+            for f in files:
+                if f.lower().endswith('.oct'):
+                    path = os.path.join(root, f)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue # removed since os.walk listed it
+                    if known.pop(path, None) != (st.st_size, st.st_mtime_ns):
+                        todo.append(path)
+        insert = 'INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(', '.join(catalog_columns), ', '.join('?' * len(catalog_columns)))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            entries = pool.map(get_OCTCatalogEntry, todo)
+            with db:
+                for path, entry in zip(todo, entries):
+                    if entry is None:
+                        known[path] = None # removed while reading
+                    else:
+                        db.execute(insert, [entry[c] for c in catalog_columns])
+                # the remaining known files were not found anymore
+                db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in known])
+        return len(todo) - sum(path in known for path in todo), len(known)
+    finally:
+        db.close()
+
+def query_OCTCatalog(catalog_filename, model=None, acquisition_mode=None, comment=None, data_file=None,
+                     min_size_y=None, where=None, params=(), **columns):
+    """
+    Return the catalog rows as dicts that match all given conditions:
+    model and acquisition_mode are compared exactly, comment and data_file (e.g. 'Intensity') are substrings,
+    min_size_y is the minimum SizeY, other keyword arguments compare a column exactly (e.g. size_x=512),
+    and where is an additional SQL condition with params, e.g. where='refractive_index > ?', params=(1.3,).
+    """
+    conditions, values = [], []
+    for column, value in dict(columns, model=model, acquisition_mode=acquisition_mode).items():
+        if column not in catalog_columns:
+            raise ValueError('Unknown catalog column {}'.format(column))
+        if value is not None:
+            conditions.append('{} = ?'.format(column))
+            values.append(value)
+    if comment is not None:
+        conditions.append("comment LIKE ? ESCAPE '\\'")
+        values.append('%{}%'.format(_like_escape(comment)))
+    if data_file is not None:
+        conditions.append("data_files LIKE ? ESCAPE '\\'")
+        values.append('%{}%'.format(_like_escape(data_file)))
+    if min_size_y is not None:
+        conditions.append('size_y >= ?')
+        values.append(min_size_y)
+    if where is not None:
+        conditions.append('({})'.format(where))
+        values.extend(params)
+    sql = 'SELECT * FROM files' + (' WHERE ' + ' AND '.join(conditions) if conditions else '') + ' ORDER BY path'
+    db = open_OCTCatalog(catalog_filename)
+    try:
+        return [dict(row) for row in db.execute(sql, values)]
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('catalog')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_update = subparsers.add_parser('update')
+    parser_update.add_argument('directory')
+    parser_update.add_argument('--workers', type=int, default=8)
+    parser_query = subparsers.add_parser('query')
+    parser_query.add_argument('--model')
+    parser_query.add_argument('--acquisition-mode')
+    parser_query.add_argument('--comment')
+    parser_query.add_argument('--data-file')
+    parser_query.add_argument('--min-size-y', type=int)
+    parser_query.add_argument('--where')
+    args = parser.parse_args()
+    if args.command == 'update':
+        num_read, num_removed = update_OCTCatalog(args.catalog, args.directory, args.workers)
+        print('{} file(s) read, {} removed'.format(num_read, num_removed))
+    else:
+        for row in query_OCTCatalog(args.catalog, args.model, args.acquisition_mode, args.comment, args.data_file,
+                                    args.min_size_y, args.where):
+            print('\t'.join(str(row[c]) for c in ['path', 'model', 'acquisition_mode', 'size_x', 'size_y', 'size_z', 'comment']))
@@ -10,19 +10,25 @@ The function returns also the mat-file data as a dictionary
 mat_data = OCT_converter.OCTtoMATraw('test.oct')
 
 See end at this file to modify the output filename pattern.
+
+Large files can be converted with a bounded amount of memory using
+OCT_converter.OCTtoNPYstream('<fname>.oct') # saves the folder '<fname>_npy'
+
+Reconstructed log10 intensity quantized to 8 or 16 bit
+OCT_converter.OCTtoLogNPY('<fname>.oct', dtype='uint8') # saves the folder '<fname>_log'
 """
 import numpy as np
-from scipy.fftpack import fft,ifft
-from scipy.interpolate import interp1d
-import matplotlib; matplotlib.use('Qt5Agg')
-import matplotlib.pyplot as pp
 import xmltodict
 import os
 import re
+import shutil
 import zipfile
 import json
 import warnings
 from warnings import warn
+from OCT_core import OCT_read_workers, check_OCTDataPlan, compile_OCTHeader, iter_OCTMembers, readinto_OCTMembers
+from OCT_instrument import stage
+from OCT_processing import OCTBackground
 formatwarning_orig = warnings.formatwarning
 warnings.formatwarning = lambda message, category, filename, lineno, line=None: \
     formatwarning_orig(message, category, filename='', lineno='', line='')
@@ -49,146 +55,459 @@ def shorten_dict_keys( in_dict ):
             out_dict[k] = v
     return out_dict
 
-def OCTtoMATraw(oct_filename):
+def OCTtoMATraw(oct_filename, workers=None):
     """
     Convert OCT to MAT file format.
     Keep all data raw; do not process.
     See test_OCT_convert.m of how to use.
+    The Spectral data are read by workers threads (default OCT_core.OCT_read_workers)
+    straight into the frames of Spectral and Spectral_apo without intermediate copies.
+    Background is the mean of all apodization lines (see OCT_processing.OCTBackground).
+    The npy file is a pickled dict which is loaded completely into memory;
+    use OCTtoNPYstream and load_NPYFolder for memory-mapped arrays.
     """
-    # Create a python_types dictionary for required data types
-    # I.e. the Thorlabs concept can mean a "Raw - signed - 2 bytes" --> np.int16
-    python_dtypes = {'Colored': {4: np.int32, 2: np.int16},
-                     'Real': {4: np.float32},
-                     'Raw': {'signed': {1: np.int8, 2: np.int16},
-                             'unsigned': {1: np.uint8, 2: np.uint16}}}
     with zipfile.ZipFile(file=oct_filename) as zf:
         mat_data = {}
-        mat_data['Header'] = xmltodict.parse(zf.read('Header.xml'))
-        is_signed = mat_data['Header']['Ocity']['Instrument']['RawDataIsSigned'].replace('True','signed').replace('False','unsigned')
-        mat_data['Header'] = shorten_dict_keys(mat_data['Header'])
-        # create a separate DataFileDict
-        mat_data['Header']['DataFileDict'] = {}
-        for file_object in (mat_data['Header']['Ocity']['DataFiles']['DataFile']):
-            print(file_object)
-            inoct_filename = file_object['#text'].split('data\\')[1].split('.data')[0] #remove the data\\ part and '.data'
-            mat_data['Header']['DataFileDict'][inoct_filename] = dict(shorten_dict_keys(file_object))
+        mat_data['Header'], layout = read_ConverterHeader(zf)
         mat_data['py_Header'] = json.dumps(mat_data['Header']) # For Python we need to use json
 
+        # Spectral0 may be only Apo data; then Spectral1 defines the shape and type of all raw Spectral data.
+        mat_data['Spectral'] = np.zeros(layout['Spectral'], dtype=layout['dtype'])
+        mat_data['Spectral_apo'] = np.zeros(layout['Spectral_apo'], dtype=layout['dtype'])
 
-        # test if SizeY exist
-        if mat_data['Header']['Ocity']['Image']['SizePixel'].get('SizeY'):
-            # Add one to include last number for array/matrix allocation indexing.
-            SizeY = int(mat_data['Header']['Ocity']['Image']['SizePixel']['SizeY']) + 1
-        else:
-            SizeY = 1
-
-        Spectral0_only = True
-        scan_range_len = None
-        S0ar_len = None
-        S1ar_len = None
-
-        S0arr_type = (mat_data['Header']['DataFileDict']['Spectral0']['Type'])
-        S0SizeZ = int(mat_data['Header']['DataFileDict']['Spectral0']['SizeZ'])
-        S0SizeX = int(mat_data['Header']['DataFileDict']['Spectral0']['SizeX'])
-        S0bpp = int(mat_data['Header']['DataFileDict']['Spectral0']['BytesPerPixel'])
-        S0ar_start = int(mat_data['Header']['DataFileDict']['Spectral0']['ApoRegionStart0'])
-        S0ar_end = int(mat_data['Header']['DataFileDict']['Spectral0']['ApoRegionEnd0'])
-        S0ar_len = S0ar_end - S0ar_start
-        if mat_data['Header']['DataFileDict']['Spectral0'].get('ScanRegionStart0'):
-            S0sr_start  = int(mat_data['Header']['DataFileDict']['Spectral0']['ScanRegionStart0'])
-            S0sr_end    = int(mat_data['Header']['DataFileDict']['Spectral0']['ScanRegionEnd0'])
-            scan_range_len = S0sr_end - S0sr_start
-            # If scan region exist prepare Spectral
-            Spectral = np.zeros([SizeY, scan_range_len, S0SizeZ])
-
-        S0dtype = python_dtypes[S0arr_type][is_signed][S0bpp]
-        Spectral_apo = np.zeros([SizeY, S0ar_len, S0SizeZ])
-
-        # Test if a Spectral1.data exist and extract parameters and use for all other raw Spectral data.
-        # We use Spectral1.data as it can be that Spectral0.data is a complete different type of ApodizationSpectrum.
-        if mat_data['Header']['DataFileDict'].get('Spectral1'):
-            Spectral0_only = False
-            S1arr_type  = mat_data['Header']['DataFileDict']['Spectral1']['Type']
-            S1SizeZ     = int(mat_data['Header']['DataFileDict']['Spectral1']['SizeZ'])
-            S1SizeX     = int(mat_data['Header']['DataFileDict']['Spectral1']['SizeX'])
-            S1bpp       = int(mat_data['Header']['DataFileDict']['Spectral1']['BytesPerPixel'])
-            if mat_data['Header']['DataFileDict']['Spectral1'].get('ApoRegionStart0'):
-                S1ar_start = int(mat_data['Header']['DataFileDict']['Spectral1']['ApoRegionStart0'])
-                S1ar_end = int(mat_data['Header']['DataFileDict']['Spectral1']['ApoRegionEnd0'])
-                S1ar_len = S1ar_end - S1ar_start
-                Spectral_apo = np.zeros([SizeY, S1ar_len, S1SizeZ])
-            S1sr_start  = int(mat_data['Header']['DataFileDict']['Spectral1']['ScanRegionStart0'])
-            S1sr_end    = int(mat_data['Header']['DataFileDict']['Spectral1']['ScanRegionEnd0'])
-            scan_range_len = S1sr_end - S1sr_start
-            S1dtype     = python_dtypes[S1arr_type][is_signed][S1bpp]
-
-            # If Spectral1 exist prepare data array with that because Spectral0 may be only Apo data
-            Spectral = np.zeros([SizeY, scan_range_len, S1SizeZ])
-
-        # Loop over all remaining items
-        for item in zf.filelist:
-            print(item.filename)
-
-            if 'Spectral0' in item.filename and mat_data['Header']['DataFileDict']['Spectral0'].get('ScanRegionStart0'):
-                # If Spectral0 exists and has parameter ScanRegionStart0 split raw and apo data.
-                S0sr_start = int(mat_data['Header']['DataFileDict']['Spectral0']['ScanRegionStart0'])
-                S0sr_end = int(mat_data['Header']['DataFileDict']['Spectral0']['ScanRegionEnd0'])
-                data = np.frombuffer(zf.read(item.filename), dtype=(S0dtype, [S0SizeX, S0SizeZ]))[0]
-                Spectral[0] = data[S0sr_start:S0sr_end, :]
-                Spectral_apo[0] = data[S0ar_start:S0ar_end, :]
-
-            elif 'Spectral0' in item.filename and mat_data['Header']['DataFileDict']['Spectral0'].get('ApoRegionStart0'):
-                # If Spectral0 and ApoRegionStart0 exists read it as a complete Apodization spectrum
-                # Add dimension for Y assuming a 3D matrix with 1 frame.
-                data = np.frombuffer(zf.read(item.filename), dtype=(S0dtype, [1,S0SizeX, S0SizeZ]))[0]
-                Spectral_apo = data
-
-            elif 'Spectral1' in item.filename and mat_data['Header']['DataFileDict']['Spectral1'].get('ApoRegionStart0'):
-                # If Spectral1 exists and has ApoRegionStart0 split raw and apo data.
-                S1ar_start = int(mat_data['Header']['DataFileDict']['Spectral1']['ApoRegionStart0'])
-                S1ar_end = int(mat_data['Header']['DataFileDict']['Spectral1']['ApoRegionEnd0'])
-                data = np.frombuffer(zf.read(item.filename), dtype=(S1dtype,[S1SizeX,S1SizeZ]))[0]
-                Spectral_apo[1] = data[S1ar_start:S1ar_end,:]
-                Spectral[1] = data[S1sr_start:S1sr_end,:]
-
-            elif 'Spectral' in item.filename and not('Spectral0' in item.filename):
-                # If any Spectral (n>1) data exist and is not n=0, then it has no ApoRegion extract as full raw data.
-                data = np.frombuffer(zf.read(item.filename), dtype=(S1dtype,[S1SizeX,S1SizeZ]))[0]
-                n = int(item.filename.split('Spectral')[1].split('.data')[0])
-                Spectral[n] = data
-
-            # otherwise extract uniquely named data sets
-            elif 'Chirp' in item.filename:
-                arr_type = mat_data['Header']['DataFileDict']['Chirp']['Type']
-                SizeZ = int(mat_data['Header']['DataFileDict']['Chirp']['SizeZ'])
-                bpp = int(mat_data['Header']['DataFileDict']['Chirp']['BytesPerPixel'])
-                py_dtype = python_dtypes[arr_type][bpp]
-                data = np.frombuffer(zf.read(item.filename),dtype=(py_dtype, SizeZ))
-                mat_data['Chirp'] = data
-            elif 'ApodizationSpectrum' in item.filename:
-                arr_type = mat_data['Header']['DataFileDict']['ApodizationSpectrum']['Type']
-                SizeZ = int(mat_data['Header']['DataFileDict']['ApodizationSpectrum']['SizeZ'])
-                bpp = int(mat_data['Header']['DataFileDict']['ApodizationSpectrum']['BytesPerPixel'])
-                py_dtype = python_dtypes[arr_type][bpp]
-                data = np.frombuffer(zf.read(item.filename),dtype=(py_dtype, SizeZ))
-                mat_data['ApodizationSpectrum'] = data
-            elif 'OffsetErrors' in item.filename:
-                arr_type = mat_data['Header']['DataFileDict']['OffsetErrors']['Type']
-                SizeZ = int(mat_data['Header']['DataFileDict']['OffsetErrors']['SizeZ'])
-                bpp = int(mat_data['Header']['DataFileDict']['OffsetErrors']['BytesPerPixel'])
-                py_dtype = python_dtypes[arr_type][bpp]
-                data = np.frombuffer(zf.read(item.filename),dtype=(py_dtype, SizeZ))
-                mat_data['OffsetErrors'] = data
-    if Spectral0_only:
-        mat_data['Spectral'] = Spectral.astype(S0dtype)
-        mat_data['Spectral_apo'] = Spectral_apo.astype(S0dtype)
-    else:
-        mat_data['Spectral'] = Spectral.astype(S1dtype)
-        mat_data['Spectral_apo'] = Spectral_apo.astype(S1dtype)
-    from scipy.io.matlab import savemat
+        # read each Spectral data file straight into its frames of Spectral and Spectral_apo
+        tasks, apo_frames = get_ConverterReadTasks(zf, layout, mat_data['Spectral'], mat_data['Spectral_apo'])
+        print('Spectral', len(tasks), 'data files')
+        readinto_OCTMembers(oct_filename, tasks, workers)
+        for name, n, data in iter_ConverterData(zf, mat_data['Header'], layout, workers, spectral=False):
+            print(name)
+            mat_data[name] = data
+        # the running mean of all apodization lines to remove DC from every frame
+        background = OCTBackground()
+        for n in apo_frames:
+            background.update(mat_data['Spectral_apo'][n])
+        mat_data['Background'] = background.spectrum
     print('Writing data ...')
-    # savemat(re.split('\.[oO][cC][tT]',oct_filename)[0]+'.mat', mat_data)
-    np.save(re.split('\.[oO][cC][tT]',oct_filename)[0], mat_data)
+    with stage('write', nbytes=mat_data['Spectral'].nbytes + mat_data['Spectral_apo'].nbytes):
+        np.save(re.split(r'\.[oO][cC][tT]',oct_filename)[0], mat_data)
     print('Done.')
     return mat_data
 
+def get_SpectralLayout(data_files, SizeY):
+    """
+    Collect where each SpectralN data file is stored in the arrays Spectral and Spectral_apo
+    from the decode plans of OCT_core.compile_OCTHeader:
+    Spectral0 can be split into raw and apo data or be only apodization data.
+    Spectral1 defines the parameters for all other raw Spectral data and may have an apo region
+    (Spectral0_only is True if there is no Spectral1).
+    SpectralN (n>1) has no apo region and is stored completely.
+    """
+    spectral = {plan['name']: check_OCTDataPlan(plan) for plan in data_files.values() if plan['index'] is not None}
+    S0 = spectral['Spectral0']
+    S1 = spectral.get('Spectral1')
+    Sref = S1 if S1 else S0
+    layout = {'dtype': Sref['dtype'], 'Spectral0_only': not S1, 'members': {}}
+
+    for name, plan in spectral.items():
+        member = {'index': plan['index'], 'plan': plan,
+                  'scan': plan['scan_region'], 'apo': plan['apo_region'], 'apo_only': False}
+        if plan['index'] == 0 and plan['scan_region'] is None and plan['apo_region'] is not None:
+            # Spectral0 is a complete apodization spectrum
+            member['apo_only'] = True
+        elif plan['index'] > 1:
+            # no apo region; extract as full raw data
+            member['scan'], member['apo'] = slice(0, plan['shape'][0]), None
+        layout['members'][plan['filename']] = member
+
+    scan = Sref['scan_region']
+    layout['Spectral'] = (SizeY, scan.stop - scan.start, Sref['shape'][1])
+    if S0['scan_region'] is None and S0['apo_region'] is not None:
+        layout['Spectral_apo'] = (1,) + S0['shape']
+    else:
+        apo = Sref['apo_region'] or S0['apo_region']
+        layout['Spectral_apo'] = (SizeY, apo.stop - apo.start, Sref['shape'][1])
+    return layout
+
+class NPYFrameWriter:
+    """
+    Write frames [n] of a 3D array directly into a preallocated npy file.
+    Consecutive frames are collected in a buffer of at most buffer_bytes and written with one call.
+    Frames that are never written remain zero.
+    """
+    def __init__(self, filename, shape, dtype, buffer_bytes=64*2**20):
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        # create the npy header and reserve the file size
+        data = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+        self.offset = data.offset
+        del data
+        self.fid = open(filename, 'r+b')
+        self.frame_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+        self.buffer = np.empty((max(1, buffer_bytes // max(1, self.frame_bytes)),) + shape[1:], dtype=dtype)
+        self.start = 0
+        self.count = 0
+
+    def write(self, n, frame):
+        if self.count and (n != self.start + self.count or self.count == len(self.buffer)):
+            self.flush()
+        if self.count == 0:
+            self.start = n
+        self.buffer[self.count] = frame
+        self.count += 1
+
+    def flush(self):
+        if self.count:
+            with stage('write', nbytes=self.count * self.frame_bytes):
+                self.fid.seek(self.offset + self.start * self.frame_bytes)
+                self.fid.write(memoryview(self.buffer[:self.count]).cast('B'))
+            self.count = 0
+
+    def close(self):
+        self.flush()
+        self.fid.close()
+
+def read_ConverterHeader(zf):
+    """
+    Read Header.xml of an open OCT archive as it is stored by the converters.
+    Returns the Header with shortened keys and DataFileDict, and the layout of the Spectral data.
+    """
+    xmldoc = zf.read('Header.xml')
+    with stage('header parse', nbytes=len(xmldoc)):
+        Header = xmltodict.parse(xmldoc)
+        data_files = compile_OCTHeader(Header)
+        Header = shorten_dict_keys(Header)
+        # create a separate DataFileDict
+        Header['DataFileDict'] = {plan['name']: dict(shorten_dict_keys(plan['metadata'])) for plan in data_files.values()}
+
+    # test if SizeY exist
+    if Header['Ocity']['Image']['SizePixel'].get('SizeY'):
+        # Add one to include last number for array/matrix allocation indexing.
+        SizeY = int(Header['Ocity']['Image']['SizePixel']['SizeY']) + 1
+    else:
+        SizeY = 1
+    layout = get_SpectralLayout(data_files, SizeY)
+    layout['data_files'] = data_files
+    return Header, layout
+
+def get_ConverterReadTasks(zf, layout, spectral, spectral_apo):
+    """
+    Collect the tasks (zinfo, regions) for OCT_core.readinto_OCTMembers that read each Spectral data file
+    of an open OCT archive straight into its frames of spectral [y, x, z] and spectral_apo.
+    The apo and scan regions are contiguous byte ranges of a data file, hence, the frames are views without copies.
+    Returns the tasks and the frames of spectral_apo that are read in the order of the archive.
+    """
+    tasks, apo_frames = [], []
+    for item in zf.filelist:
+        member = layout['members'].get(item.filename.replace('/', '\\'))
+        if member is None:
+            continue
+        plan = member['plan']
+        line_bytes = plan['shape'][1] * plan['dtype'].itemsize
+        if member['apo_only']:
+            regions = [(0, spectral_apo[0])]
+            apo_frames.append(0)
+        else:
+            regions = []
+            if member['apo'] is not None:
+                regions.append((member['apo'].start * line_bytes, spectral_apo[member['index']]))
+                apo_frames.append(member['index'])
+            if member['scan'] is not None:
+                regions.append((member['scan'].start * line_bytes, spectral[member['index']]))
+        for offset, out in regions:
+            if offset + out.nbytes > item.file_size:
+                raise ValueError('Spectral data {} is smaller than its frame of {} bytes.'.format(plan['name'], out.nbytes))
+        tasks.append((item, regions))
+    return tasks, apo_frames
+
+def iter_ConverterData(zf, Header, layout, workers=None, max_pending=None, spectral=True):
+    """
+    Decode the data files of an open OCT archive one by one in the order of the archive.
+    Yields (name, n, data) where the Spectral data are split into frames n of 'Spectral' and 'Spectral_apo'
+    and the 1D data sets 'Chirp', 'ApodizationSpectrum', 'OffsetErrors' have n = None.
+    spectral=False yields only the 1D data sets.
+    The members are inflated ahead by workers threads (see OCT_core.iter_OCTMembers);
+    at most max_pending members are held in memory.
+    """
+    items = []
+    for item in zf.filelist:
+        data_name = item.filename.replace('/', '\\')
+        if (spectral and data_name in layout['members']) or (data_name in layout['data_files'] and
+                layout['data_files'][data_name]['name'] in ['Chirp', 'ApodizationSpectrum', 'OffsetErrors']):
+            items.append(item)
+    for item, data in iter_OCTMembers(zf.filename, items, workers, max_pending):
+        data_name = item.filename.replace('/', '\\')
+        if data_name in layout['members']:
+            member = layout['members'][data_name]
+            plan = member['plan']
+            with stage('decode', nbytes=len(data)):
+                data = np.frombuffer(data, dtype=(plan['dtype'], plan['shape']))[0]
+            if member['apo_only']:
+                yield 'Spectral_apo', 0, data
+                continue
+            if member['apo'] is not None:
+                yield 'Spectral_apo', member['index'], data[member['apo']]
+            if member['scan'] is not None:
+                yield 'Spectral', member['index'], data[member['scan']]
+        else:
+            plan = check_OCTDataPlan(layout['data_files'][data_name])
+            yield plan['name'], None, np.frombuffer(data, dtype=(plan['dtype'], plan['shape']))
+
+def OCTtoNPYstream(oct_filename, memory_budget=256*2**20, workers=None):
+    """
+    Convert OCT to a folder of npy files without holding the whole volume in memory.
+    Each frame is decoded as it is read from the archive and written into the preallocated
+    Spectral.npy and Spectral_apo.npy in the original raw data type.
+    The memory for inflated frames and frames waiting to be written is limited to memory_budget bytes.
+    The members are inflated by workers threads (default OCT_core.OCT_read_workers).
+    All other data sets are saved with the same name without '.data' and the header as Header.json.
+    Background.npy is the mean of all apodization lines (see OCT_processing.OCTBackground).
+    The folder is written under a temporary name and renamed when complete, so that readers never see
+    a partial conversion and an existing folder is replaced only by a complete one. Use load_NPYFolder to read it.
+    """
+    out_dir = re.split(r'\.[oO][cC][tT]',oct_filename)[0] + '_npy'
+    write_FolderAtomic(out_dir, write_NPYFolder, oct_filename, memory_budget=memory_budget, workers=workers)
+    print('Done.')
+    return out_dir
+
+def write_FolderAtomic(out_dir, write_folder, *args, **kwargs):
+    """
+    Call write_folder(*args, out_dir=<temporary folder>, **kwargs) and rename the temporary folder to out_dir when complete.
+    An existing out_dir is replaced only by a complete folder; a failed write leaves no temporary folder.
+    """
+    partial_dir = '{}.partial-{}'.format(out_dir, os.getpid())
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir)
+    try:
+        write_folder(*args, out_dir=partial_dir, **kwargs)
+    except BaseException:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        raise
+    with stage('write'):
+        if os.path.exists(out_dir):
+            # os.replace cannot replace a non-empty folder; keep the old folder until the new one is in place
+            old_dir = '{}.old-{}'.format(out_dir, os.getpid())
+            os.rename(out_dir, old_dir)
+            os.rename(partial_dir, out_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.rename(partial_dir, out_dir)
+
+def write_NPYFolder(oct_filename, out_dir, memory_budget=256*2**20, workers=None):
+    """
+    Write the arrays of the OCT file as npy files and Header.json into the existing folder out_dir (see OCTtoNPYstream).
+    """
+    with zipfile.ZipFile(file=oct_filename) as zf:
+        Header, layout = read_ConverterHeader(zf)
+        with open(os.path.join(out_dir, 'Header.json'), 'w') as fid:
+            json.dump(Header, fid)
+
+        # up to a quarter of the budget for members inflated ahead; one half of the rest for each array
+        frame_bytes = max(int(np.prod(layout['Spectral'][1:])), int(np.prod(layout['Spectral_apo'][1:]))) * layout['dtype'].itemsize
+        if memory_budget < 3 * frame_bytes:
+            warn('memory_budget {} is smaller than three frames of {} bytes.'.format(memory_budget, frame_bytes))
+        member_bytes = max(member['plan']['nbytes'] for member in layout['members'].values())
+        max_pending = max(1, min(2 * (workers or OCT_read_workers), memory_budget // 4 // max(1, member_bytes)))
+        buffer_bytes = max(0, memory_budget - max_pending * member_bytes) // 2
+        writers = {name: NPYFrameWriter(os.path.join(out_dir, name + '.npy'), layout[name], layout['dtype'], buffer_bytes)
+                   for name in ['Spectral', 'Spectral_apo']}
+        try:
+            background = OCTBackground()
+            for name, n, data in iter_ConverterData(zf, Header, layout, workers, max_pending):
+                if n is None:
+                    with stage('write', nbytes=data.nbytes):
+                        np.save(os.path.join(out_dir, name + '.npy'), data)
+                else:
+                    writers[name].write(n, data)
+                    if name == 'Spectral_apo':
+                        background.update(data)
+            np.save(os.path.join(out_dir, 'Background.npy'), background.spectrum)
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+def load_NPYFolder(npy_dir, mmap_mode='r'):
+    """
+    Load a folder of OCTtoNPYstream as a dict with 'Header' and one array per npy file, e.g. 'Spectral'.
+    The arrays are memory-mapped with mmap_mode (default read-only), so only the pages that are used are read.
+    Use mmap_mode=None to load the arrays into memory.
+    """
+    data = {}
+    with open(os.path.join(npy_dir, 'Header.json')) as fid:
+        data['Header'] = json.load(fid)
+    for filename in sorted(os.listdir(npy_dir)):
+        name, ext = os.path.splitext(filename)
+        if ext == '.npy':
+            data[name] = np.load(os.path.join(npy_dir, filename), mmap_mode=mmap_mode, allow_pickle=False)
+    return data
+
+def OCTtoLogNPY(oct_filename, dtype='uint8', percentiles=(0.5, 99.9), vmin=None, vmax=None, histogram_step=1,
+               prefetch=4, precision='float32'):
+    """
+    Reconstruct the volume and save the log10 intensity quantized to dtype ('uint8' or 'uint16')
+    as Intensity.npy [y, x, z] in the folder '<name>_log' together with Header.json and LogRange.npy = [vmin, vmax].
+    The log10 intensity is restored by vmin + Intensity / max(dtype) * (vmax - vmin).
+    vmin and vmax default to the percentiles of the whole volume which are estimated in a first streaming pass
+    with a fixed-size histogram (see OCT_processing.OCTHistogram) using every histogram_step-th B-frame.
+    The reconstructed volume is never held; the frames are quantized and written one by one.
+    The folder is written atomically like OCTtoNPYstream; use load_NPYFolder to read it.
+    """
+    out_dir = re.split(r'\.[oO][cC][tT]',oct_filename)[0] + '_log'
+    write_FolderAtomic(out_dir, write_LogNPYFolder, oct_filename, dtype=dtype, percentiles=percentiles,
+                       vmin=vmin, vmax=vmax, histogram_step=histogram_step, prefetch=prefetch, precision=precision)
+    print('Done.')
+    return out_dir
+
+def write_LogNPYFolder(oct_filename, out_dir, dtype='uint8', percentiles=(0.5, 99.9), vmin=None, vmax=None,
+                       histogram_step=1, prefetch=4, precision='float32'):
+    """
+    Write the quantized log10 intensity into the existing folder out_dir (see OCTtoLogNPY).
+    """
+    from OCT_core import OCTVolume, open_OCTFile, close_OCTFile, get_OCTRealData
+    from OCT_processing import OCTHistogram, get_OCTBackground, get_OCTResamplingPlan, iter_frames
+    dtype = np.dtype(dtype)
+    max_value = np.iinfo(dtype).max
+    with zipfile.ZipFile(file=oct_filename) as zf:
+        Header, _ = read_ConverterHeader(zf)
+    with open(os.path.join(out_dir, 'Header.json'), 'w') as fid:
+        json.dump(Header, fid)
+
+    handle = open_OCTFile(oct_filename)
+    try:
+        plan = get_OCTResamplingPlan(get_OCTRealData(handle, 'data\\Chirp.data'))
+        dc = get_OCTBackground(handle)
+        frames_args = dict(prefetch=prefetch, plan=plan, dc=dc, precision=precision)
+        if vmin is None or vmax is None:
+            histogram = OCTHistogram()
+            for image in iter_frames(handle, frames=slice(None, None, histogram_step), **frames_args):
+                histogram.add(image)
+            low, high = histogram.percentile(percentiles)
+            vmin = low if vmin is None else vmin
+            vmax = high if vmax is None else vmax
+        print('log10 range [{}, {}]'.format(vmin, vmax))
+        np.save(os.path.join(out_dir, 'LogRange.npy'), np.array([vmin, vmax], dtype=np.float64))
+
+        num_frames = OCTVolume(handle).shape[0]
+        writer = None
+        scale = max_value / max(vmax - vmin, np.finfo(np.float32).tiny)
+        try:
+            for y, image in enumerate(iter_frames(handle, **frames_args)):
+                if writer is None:
+                    writer = NPYFrameWriter(os.path.join(out_dir, 'Intensity.npy'), (num_frames,) + image.shape, dtype)
+                with stage('decode', nbytes=image.nbytes):
+                    image -= vmin
+                    image *= scale
+                    np.nan_to_num(image, copy=False, nan=0, posinf=max_value, neginf=0)
+                    np.clip(image, 0, max_value, out=image)
+                    np.rint(image, out=image)
+                writer.write(y, image.astype(dtype))
+        finally:
+            if writer is not None:
+                writer.close()
+    finally:
+        close_OCTFile(handle)
+
+def write_MAT73Value(group, key, value):
+    """
+    Write a Header value into a HDF5 group in the layout of MATLAB v7.3 MAT files.
+    dicts become structs, lists become cell arrays and all other values become char arrays.
+    """
+    if isinstance(value, dict):
+        sub_group = group.create_group(key)
+        sub_group.attrs['MATLAB_class'] = np.bytes_('struct')
+        for k, v in value.items():
+            write_MAT73Value(sub_group, k, v)
+        return sub_group
+    if isinstance(value, list):
+        # cell arrays store references to the items in the group '#refs#'
+        import h5py
+        refs = group.file.require_group('#refs#')
+        dset = group.create_dataset(key, shape=(len(value), 1), dtype=h5py.ref_dtype)
+        for n, v in enumerate(value):
+            if isinstance(v, dict):
+                v = shorten_dict_keys(v) # the items of lists are not shortened yet
+            item = write_MAT73Value(refs, '{}_{}'.format(len(refs), n), v)
+            dset[n, 0] = item.ref
+        dset.attrs['MATLAB_class'] = np.bytes_('cell')
+        return dset
+    value = str(value)
+    if len(value) == 0:
+        dset = group.create_dataset(key, data=np.array([0, 0], dtype=np.uint64))
+        dset.attrs['MATLAB_empty'] = np.uint8(1)
+    else:
+        # MATLAB char row vector [1, N] is stored as [N, 1] in HDF5
+        dset = group.create_dataset(key, data=np.frombuffer(value.encode('utf-16-le'), dtype=np.uint16)[:, None])
+    dset.attrs['MATLAB_class'] = np.bytes_('char')
+    dset.attrs['MATLAB_int_decode'] = np.int32(2)
+    return dset
+
+def OCTtoMAT73(oct_filename, compression='gzip', compression_opts=4, workers=None):
+    """
+    Convert OCT to a MATLAB v7.3 MAT file which is a HDF5 file and has no 2 GB limit.
+    Requires the package h5py.
+
+    Spectral and Spectral_apo are chunked datasets with one B-frame per chunk and
+    are written frame by frame as they are read from the OCT file.
+    Use compression=None to store the data uncompressed.
+    MATLAB stores arrays in column-major order, hence, all arrays are stored transposed in the HDF5 file
+    and MATLAB reads Spectral(y, x, z) the same as the mat-file of OCTtoMATraw.
+    Use read_MAT73 to read frames in Python.
+    The members are inflated by workers threads (default OCT_core.OCT_read_workers).
+    Background is the mean of all apodization lines (see OCT_processing.OCTBackground).
+    """
+    import h5py
+    import time
+    mat_filename = re.split(r'\.[oO][cC][tT]',oct_filename)[0]+'.mat'
+    with zipfile.ZipFile(file=oct_filename) as zf, h5py.File(mat_filename, 'w', userblock_size=512) as h5:
+        Header, layout = read_ConverterHeader(zf)
+        write_MAT73Value(h5, 'Header', Header)
+        write_MAT73Value(h5, 'py_Header', json.dumps(Header)) # For Python we need to use json
+
+        matlab_class = {np.dtype(t): t.__name__ for t in [np.int8, np.uint8, np.int16, np.uint16, np.int32]}
+        matlab_class[np.dtype(np.float32)] = 'single'
+        for name in ['Spectral', 'Spectral_apo']:
+            shape = layout[name][::-1]
+            dset = h5.create_dataset(name, shape=shape, dtype=layout['dtype'], chunks=shape[:2] + (1,),
+                                     compression=compression, compression_opts=compression_opts if compression == 'gzip' else None)
+            dset.attrs['MATLAB_class'] = np.bytes_(matlab_class[layout['dtype']])
+
+        background = OCTBackground()
+        for name, n, data in iter_ConverterData(zf, Header, layout, workers):
+            print(name, '' if n is None else n)
+            with stage('write', nbytes=data.nbytes):
+                if n is None:
+                    dset = h5.create_dataset(name, data=data.T)
+                    dset.attrs['MATLAB_class'] = np.bytes_(matlab_class[data.dtype])
+                else:
+                    h5[name][:, :, n] = data.T
+            if name == 'Spectral_apo':
+                background.update(data)
+        if background.spectrum is not None:
+            dset = h5.create_dataset('Background', data=background.spectrum)
+            dset.attrs['MATLAB_class'] = np.bytes_('double')
+
+    # MATLAB identifies v7.3 files by the text header in the HDF5 user block
+    text = 'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: {} HDF5 schema 1.00 .'.format(time.strftime('%a %b %d %H:%M:%S %Y'))
+    with open(mat_filename, 'r+b') as fid:
+        fid.write(text.encode().ljust(116) + bytes(8) + b'\x00\x02' + b'IM')
+    print('Done.')
+    return mat_filename
+
+def read_MAT73(mat_filename, name='Spectral', y=slice(None), x=slice(None), z=slice(None)):
+    """
+    Read frames y or a sub-volume [y, x, z] of Spectral, Spectral_apo, or 1D data from a file of OCTtoMAT73.
+    Only the chunks of the selected B-frames are read from the file.
+    """
+    import h5py
+    with h5py.File(mat_filename, 'r') as h5:
+        dset = h5[name]
+        if dset.ndim == 3:
+            return dset[z, x, y].T
+        return dset[()].T
+
+def read_MAT73Header(mat_filename):
+    """
+    Read the Header dictionary from a file of OCTtoMAT73.
+    """
+    import h5py
+    with h5py.File(mat_filename, 'r') as h5:
+        return json.loads(h5['py_Header'][:, 0].tobytes().decode('utf-16-le'))
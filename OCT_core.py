@@ -0,0 +1,896 @@
+"""
+Core functions to read Thorlabs OCT files.
+
+This module imports only numpy, xmltodict, and the standard library (zipfile, ...)
+to be fast to import on headless machines and in short-lived worker processes.
+Do not import matplotlib or scipy here; OCT_reader provides those lazily.
+"""
+import numpy as np
+import xmltodict
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import warnings
+from warnings import warn
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from OCT_instrument import stage
+formatwarning_orig = warnings.formatwarning
+warnings.formatwarning = lambda message, category, filename, lineno, line=None: \
+    formatwarning_orig(message, category, filename='', lineno='', line='')
+
+# Create a python_types dictionary for required data types
+# I.e. the Thorlabs concept can mean a "Raw - signed - 2 bytes" --> np.int16
+python_dtypes = {'Colored': {'4': np.int32, '2': np.int16},
+                 'Real': {'4': np.float32},
+                 'Raw': {'signed': {'1': np.int8, '2': np.int16},
+                         'unsigned': {'1': np.uint8, '2': np.uint16}}}
+
+# The extracted OCT files are kept in $TMP/OCTData up to this number of bytes.
+# The least recently used files are removed first. Set the environment variable OCT_CACHE_BYTES to change.
+OCT_cache_bytes = int(os.environ.get('OCT_CACHE_BYTES', 20*2**30))
+
+# Number of threads inflating the members of an OCT file concurrently (zlib releases the GIL).
+# Set the environment variable OCT_READ_WORKERS to change; 1 reads the members one after another.
+OCT_read_workers = int(os.environ.get('OCT_READ_WORKERS', min(8, os.cpu_count() or 1)))
+
+# Number of archives kept open per process for unpickled OCTVolumes (see get_OCTProcessHandle).
+# Set the environment variable OCT_PROCESS_HANDLES to change; the least recently used archive is closed first.
+OCT_process_handles = int(os.environ.get('OCT_PROCESS_HANDLES', 32))
+
+def get_OCTCacheFolder(filename, cache_path=None):
+    """
+    Return the folder in the cache for the OCT file.
+    The folder name is the basename and a key of the file size, mtime, and a hash of Header.xml,
+    so that different files with the same name do not collide and changed files are extracted again.
+    """
+    if cache_path is None:
+        cache_path = os.path.join(tempfile.gettempdir(), 'OCTData')
+    stat = os.stat(filename)
+    with zipfile.ZipFile(file=filename) as zf:
+        header_hash = hashlib.sha1(zf.read('Header.xml')).hexdigest()
+    key = hashlib.sha1('{}:{}:{}'.format(stat.st_size, stat.st_mtime_ns, header_hash).encode()).hexdigest()[:16]
+    return os.path.join(cache_path, '{}_{}'.format(os.path.basename(filename).split('.oct')[0], key))
+
+def get_FolderBytes(folder):
+    """
+    Total number of bytes of all files below folder.
+    """
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(folder) for f in files)
+
+def list_OCTCache(cache_path=None):
+    """
+    List all complete entries in the cache sorted from least to most recently used.
+    The entries are the extracted OCT files and the preview pyramids (see build_OCTPyramids).
+    Each entry is a dict with 'folder', 'kind' ('extract' or 'pyramids'), 'filename', 'bytes',
+    and 'last_used' (time stamp).
+    """
+    if cache_path is None:
+        cache_path = os.path.join(tempfile.gettempdir(), 'OCTData')
+    entries = []
+    for kind, path in (('extract', cache_path), ('pyramids', os.path.join(cache_path, 'pyramids'))):
+        if not os.path.exists(path):
+            continue
+        for folder in os.listdir(path):
+            if '.partial-' in folder:
+                continue # in-flight extraction with its marker written before the rename
+            marker = os.path.join(path, folder, '.complete')
+            if not os.path.exists(marker):
+                continue
+            with open(marker) as fid:
+                entry = json.load(fid)
+            if 'bytes' not in entry:
+                # pyramids built before their size was recorded
+                entry['bytes'] = get_FolderBytes(os.path.join(path, folder))
+            entry.update({'folder': os.path.join(path, folder), 'kind': kind, 'last_used': os.path.getmtime(marker)})
+            entries.append(entry)
+    return sorted(entries, key=lambda e: e['last_used'])
+
+def size_OCTCache(cache_path=None):
+    """
+    Total number of bytes of all complete entries in the cache, including the preview pyramids.
+    """
+    return sum(entry['bytes'] for entry in list_OCTCache(cache_path))
+
+def is_stale_OCTPartial(folder, max_age=24*3600):
+    """
+    True if folder is a '.partial-<pid>' folder left by an extraction that no longer runs:
+    the process pid does not exist (POSIX) or the folder was not modified for max_age seconds.
+    """
+    match = re.search(r'\.partial-(\d+)$', folder)
+    if match is None:
+        return False
+    pid = int(match.group(1))
+    if pid == os.getpid():
+        return False
+    if os.name == 'posix':
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass # the process exists but belongs to another user
+    try:
+        return time.time() - os.path.getmtime(folder) > max_age
+    except OSError:
+        return False
+
+def remove_stale_OCTPartials(path):
+    """
+    Remove the stale partial folders in path (see is_stale_OCTPartial). Returns the removed folders.
+    """
+    removed = []
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            folder = os.path.join(path, name)
+            if is_stale_OCTPartial(folder):
+                shutil.rmtree(folder, ignore_errors=True)
+                removed.append(folder)
+    return removed
+
+def rename_OCTPartial(partial_folder, folder):
+    """
+    Rename the completed partial_folder to folder. A complete folder (with .complete marker) of another process
+    is kept and partial_folder is removed; an incomplete folder in the way is removed and the rename retried.
+    Returns True if partial_folder was renamed.
+    """
+    for attempt in range(3):
+        try:
+            os.rename(partial_folder, folder)
+            return True
+        except OSError:
+            if os.path.exists(os.path.join(folder, '.complete')):
+                # another process completed the same file first
+                shutil.rmtree(partial_folder, ignore_errors=True)
+                return False
+            if attempt == 2 or not os.path.exists(folder):
+                raise
+            # e.g. left by an interrupted purge
+            shutil.rmtree(folder, ignore_errors=True)
+
+def purge_OCTCache(max_bytes=0, cache_path=None, keep=()):
+    """
+    Remove the least recently used entries (extracted files and preview pyramids) until the cache has at most max_bytes.
+    purge_OCTCache() removes all entries. Folders in keep are not removed.
+    Partial folders of killed extractions are always removed (see is_stale_OCTPartial).
+    Returns the list of removed entries.
+    """
+    if cache_path is None:
+        cache_path = os.path.join(tempfile.gettempdir(), 'OCTData')
+    remove_stale_OCTPartials(cache_path)
+    remove_stale_OCTPartials(os.path.join(cache_path, 'pyramids'))
+    entries = list_OCTCache(cache_path)
+    total = sum(entry['bytes'] for entry in entries)
+    removed = []
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry['folder'] in keep:
+            continue
+        # remove the marker first; an entry without marker is never reused
+        os.remove(os.path.join(entry['folder'], '.complete'))
+        shutil.rmtree(entry['folder'], ignore_errors=True)
+        total -= entry['bytes']
+        removed.append(entry)
+    return removed
+
+def get_OCTPyramidFolder(cache_folder):
+    """
+    Folder of the preview pyramids next to the cache folder of an OCT file (see get_OCTCacheFolder).
+    """
+    cache_path, name = os.path.split(cache_folder)
+    return os.path.join(cache_path, 'pyramids', name)
+
+def unzip_OCTFile(filename, cache_bytes=None, workers=None):
+    """
+    Unzip the OCT file into a temp folder with workers threads (default OCT_read_workers).
+    The temp folder is reused only if the extraction was completed for exactly the same file.
+    Afterwards the least recently used files are removed if the cache has more than cache_bytes
+    (default OCT_cache_bytes).
+    """
+    handle = dict()
+    handle['filename'] = filename
+    handle['path'] = os.path.join(tempfile.gettempdir(), 'OCTData')
+
+    temp_oct_data_folder = get_OCTCacheFolder(filename, handle['path'])
+    handle['temp_oct_data_folder'] = temp_oct_data_folder
+    marker = os.path.join(temp_oct_data_folder, '.complete')
+    if os.path.exists(marker):
+        warn('Reuse data in {}\n'.format(temp_oct_data_folder))
+        os.utime(marker, ns=(time.time_ns(), time.time_ns())) # mark as recently used
+    else:
+        print('\nTry to extract {} into {}. Please wait.\n'.format(filename,temp_oct_data_folder))
+        os.makedirs(handle['path'], exist_ok=True)
+        # extract into a separate folder and rename it when complete
+        partial_folder = '{}.partial-{}'.format(temp_oct_data_folder, os.getpid())
+        shutil.rmtree(partial_folder, ignore_errors=True)
+        with stage('extract') as st:
+            num_bytes = extract_OCTMembers(handle['filename'], partial_folder, workers)
+            st.nbytes = num_bytes
+        with open(os.path.join(partial_folder, '.complete'), 'w') as fid:
+            json.dump({'filename': os.path.abspath(filename), 'bytes': num_bytes}, fid)
+        rename_OCTPartial(partial_folder, temp_oct_data_folder)
+
+        purge_OCTCache(OCT_cache_bytes if cache_bytes is None else cache_bytes, handle['path'], keep=(temp_oct_data_folder,))
+
+    # read Header.xml
+    with open(os.path.join(temp_oct_data_folder, 'Header.xml'),'rb') as fid:
+        up_to_EOF = -1
+        xmldoc = fid.read(up_to_EOF)
+
+    # convert Header.xml to dictionary
+    with stage('header parse', nbytes=len(xmldoc)):
+        handle_xml = xmltodict.parse(xmldoc)
+        handle.update(handle_xml)
+        handle.update({'python_dtypes': python_dtypes})
+        handle['data_files'] = compile_OCTHeader(handle)
+
+    return handle
+
+def open_OCTFile(filename):
+    """
+    Open the OCT file and keep the archive open instead of extracting it.
+    All data files are read directly from the ZIP using read_OCTData.
+    Stored (uncompressed) members are memory-mapped, deflated members are streamed.
+    Call close_OCTFile(handle) when done.
+    """
+    handle = dict()
+    handle['filename'] = filename
+    handle['temp_oct_data_folder'] = None
+    with stage('zip open', nbytes=os.path.getsize(filename)):
+        handle['zipfile'] = zipfile.ZipFile(file=filename)
+
+    # The names in Header.xml use windows path separators 'data\\'.
+    # Register each member for both separators.
+    handle['members'] = dict()
+    for zinfo in handle['zipfile'].infolist():
+        handle['members'][zinfo.filename] = zinfo
+        handle['members'][zinfo.filename.replace('/', '\\')] = zinfo
+
+    # convert Header.xml to dictionary
+    xmldoc = handle['zipfile'].read('Header.xml')
+    with stage('header parse', nbytes=len(xmldoc)):
+        handle_xml = xmltodict.parse(xmldoc)
+        handle.update(handle_xml)
+        handle.update({'python_dtypes': python_dtypes})
+        handle['data_files'] = compile_OCTHeader(handle)
+
+    return handle
+
+def close_OCTFile(handle):
+    """
+    Close the archive of a handle created with open_OCTFile.
+    """
+    if handle.get('zipfile') is not None:
+        handle['zipfile'].close()
+        handle['zipfile'] = None
+
+def read_OCTHeader(filename):
+    """
+    Read only Header.xml of the OCT file as dict; no data file is extracted or read.
+    """
+    with zipfile.ZipFile(file=filename) as zf:
+        xmldoc = zf.read('Header.xml')
+    with stage('header parse', nbytes=len(xmldoc)):
+        return xmltodict.parse(xmldoc)
+
+def get_OCTMemberOffset(handle, zinfo):
+    """
+    Return the byte offset of the member data inside the archive.
+    The local file header can have a different extra field than the central directory,
+    hence, the lengths are read from the local header itself.
+    """
+    with open(handle['filename'], 'rb') as fid:
+        return _read_MemberOffset(fid, zinfo)
+
+def _read_MemberOffset(fid, zinfo):
+    """
+    Read the byte offset of the member data from the local file header using the open archive file fid.
+    """
+    fid.seek(zinfo.header_offset)
+    name_len, extra_len = struct.unpack('<HH', fid.read(30)[26:30])
+    return zinfo.header_offset + 30 + name_len + extra_len
+
+# Deflated members are inflated into the destination in chunks of this size.
+OCT_readinto_chunk = 2**16
+
+def _readinto_exactly(fid, view):
+    """
+    Fill the memoryview from fid in chunks of at most OCT_readinto_chunk bytes.
+    """
+    n = 0
+    while n < len(view):
+        k = fid.readinto(view[n:n + OCT_readinto_chunk])
+        if not k:
+            raise EOFError('Data file is shorter than expected.')
+        n += k
+
+def readinto_OCTMember(filename, zinfo, regions, zf=None):
+    """
+    Read byte regions of the archive member zinfo straight into writable buffers without intermediate copies.
+    regions is a list of (byte_offset, out) with C-contiguous arrays out; the regions must not overlap.
+    Stored members are read with readinto from the archive file, deflated members are inflated as a stream
+    with zf (default a new ZipFile) in chunks of OCT_readinto_chunk bytes, skipping the bytes between regions.
+    """
+    regions = sorted(regions, key=lambda region: region[0])
+    with stage('member read', nbytes=sum(out.nbytes for _, out in regions)):
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            with open(filename, 'rb', buffering=0) as fid:
+                data_offset = _read_MemberOffset(fid, zinfo)
+                for offset, out in regions:
+                    fid.seek(data_offset + offset)
+                    _readinto_exactly(fid, memoryview(out).cast('B'))
+            return
+        own_zf = zf is None
+        zf = zipfile.ZipFile(filename) if own_zf else zf
+        try:
+            with zf.open(zinfo) as fid:
+                position = 0
+                for offset, out in regions:
+                    while position < offset:
+                        skipped = len(fid.read(min(OCT_readinto_chunk, offset - position)))
+                        if not skipped:
+                            raise EOFError('Data file is shorter than expected.')
+                        position += skipped
+                    _readinto_exactly(fid, memoryview(out).cast('B'))
+                    position += out.nbytes
+        finally:
+            if own_zf:
+                zf.close()
+
+def readinto_OCTData(handle, data_name, regions):
+    """
+    Read byte regions of a data file straight into the buffers of regions (see readinto_OCTMember).
+    If the handle was created with unzip_OCTFile the data file is read from the temp folder.
+    """
+    if handle.get('zipfile') is None:
+        with open(os.path.join(handle['temp_oct_data_folder'], data_name), 'rb', buffering=0) as fid, \
+                stage('member read', nbytes=sum(out.nbytes for _, out in regions)):
+            for offset, out in regions:
+                fid.seek(offset)
+                _readinto_exactly(fid, memoryview(out).cast('B'))
+        return
+    readinto_OCTMember(handle['filename'], handle['members'][data_name], regions, handle['zipfile'])
+
+class _ThreadZipFiles:
+    """
+    One independent ZipFile of the archive for each thread; all are closed together.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.handles = []
+
+    def get(self):
+        zf = getattr(self.local, 'zipfile', None)
+        if zf is None:
+            zf = self.local.zipfile = zipfile.ZipFile(self.filename)
+            with self.lock:
+                self.handles.append(zf)
+        return zf
+
+    def close(self):
+        for zf in self.handles:
+            zf.close()
+        self.handles = []
+
+def iter_OCTMembers(filename, members, workers=None, max_pending=None):
+    """
+    Read the members (ZipInfo or names) of the archive filename with workers threads (default OCT_read_workers),
+    each with its own file handle, so that deflated members are inflated concurrently.
+    Yields (zinfo, bytes) in the order of members. At most max_pending (default 2*workers) members are read ahead.
+    """
+    workers = max(1, OCT_read_workers if workers is None else workers)
+    max_pending = max(1, max_pending or 2 * workers)
+    zipfiles = _ThreadZipFiles(filename)
+
+    def read(zinfo):
+        with stage('member read', nbytes=zinfo.file_size):
+            return zipfiles.get().read(zinfo)
+
+    try:
+        zf = zipfiles.get()
+        infos = [m if isinstance(m, zipfile.ZipInfo) else zf.getinfo(m) for m in members]
+        if workers == 1:
+            for zinfo in infos:
+                yield zinfo, read(zinfo)
+            return
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='OCT_read') as pool:
+            try:
+                for zinfo in infos:
+                    pending.append((zinfo, pool.submit(read, zinfo)))
+                    if len(pending) >= max_pending:
+                        zinfo, future = pending.popleft()
+                        yield zinfo, future.result()
+                while pending:
+                    zinfo, future = pending.popleft()
+                    yield zinfo, future.result()
+            finally:
+                for _, future in pending:
+                    future.cancel()
+    finally:
+        zipfiles.close()
+
+def readinto_OCTMembers(filename, tasks, workers=None):
+    """
+    Run readinto_OCTMember for all tasks (zinfo, regions) of the archive filename
+    with workers threads (default OCT_read_workers), each with its own file handle.
+    The regions of all tasks must be disjoint; the result does not depend on the order.
+    """
+    workers = max(1, OCT_read_workers if workers is None else workers)
+    zipfiles = _ThreadZipFiles(filename)
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='OCT_readinto') as pool:
+            list(pool.map(lambda task: readinto_OCTMember(filename, task[0], task[1], zipfiles.get()), tasks))
+    finally:
+        zipfiles.close()
+
+def extract_OCTMembers(filename, path, workers=None):
+    """
+    Extract all members of the archive filename into path like ZipFile.extractall
+    with workers threads (default OCT_read_workers), each with its own file handle.
+    Returns the number of extracted bytes.
+    """
+    workers = max(1, OCT_read_workers if workers is None else workers)
+    with zipfile.ZipFile(filename) as zf:
+        infos = zf.infolist()
+        if workers == 1:
+            zf.extractall(path=path)
+            return sum(zinfo.file_size for zinfo in infos)
+    zipfiles = _ThreadZipFiles(filename)
+
+    def extract(zinfo):
+        try:
+            return zipfiles.get().extract(zinfo, path)
+        except FileExistsError:
+            # another thread created the same folder at the same time
+            return zipfiles.get().extract(zinfo, path)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='OCT_extract') as pool:
+            # largest members first to balance the threads
+            list(pool.map(extract, sorted(infos, key=lambda zinfo: -zinfo.compress_size)))
+    finally:
+        zipfiles.close()
+    return sum(zinfo.file_size for zinfo in infos)
+
+def read_OCTData(handle, data_name, dtype, count=-1):
+    """
+    Read a data file like np.fromfile.
+    If the handle was created with unzip_OCTFile the data are read from the temp folder.
+    If the handle was created with open_OCTFile the data are read from the archive.
+    Stored members return a read-only np.memmap, deflated members read only count items from the stream.
+    """
+    if dtype is None or (isinstance(dtype, tuple) and any(d is None for d in dtype)):
+        check_OCTDataPlan(get_OCTDataFiles(handle)[data_name])
+    with stage('member read') as st:
+        if handle.get('zipfile') is None:
+            data_file = os.path.join(handle['temp_oct_data_folder'], data_name)
+            data = np.fromfile(data_file, dtype=dtype, count=count)
+            st.nbytes = data.nbytes
+            return data
+
+        dtype = np.dtype(dtype)
+        zinfo = handle['members'][data_name]
+        num_items = zinfo.file_size // dtype.itemsize
+        if count >= 0:
+            num_items = min(count, num_items)
+        st.nbytes = num_items * dtype.itemsize
+
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            offset = get_OCTMemberOffset(handle, zinfo)
+            return np.memmap(handle['filename'], dtype=dtype, mode='r', offset=offset, shape=(num_items,))
+
+        with handle['zipfile'].open(zinfo) as fid:
+            data = fid.read(num_items * dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype)
+
+def get_OCTDtype(data_type, bytes_per_pixel, sign='unsigned'):
+    """
+    Resolve the numpy dtype from the Thorlabs @Type and @BytesPerPixel, e.g. 'Raw', 2, 'signed' --> np.int16.
+    bytes_per_pixel can be a str or int and sign is only used for the type 'Raw'.
+    """
+    dtypes = python_dtypes[data_type]
+    if data_type == 'Raw':
+        dtypes = dtypes[sign]
+    return np.dtype(dtypes[str(bytes_per_pixel)])
+
+def compile_OCTHeader(handle):
+    """
+    Parse the DataFiles of Header.xml once into a dict keyed by the data file name, e.g. 'data\\Spectral0.data'.
+    Each entry is a decode plan with
+    'name' (Spectral0), 'filename', 'metadata' (the xml dict), 'type', 'dtype', 'shape' of one record,
+    'index' (n of Spectraln or None), 'apo_region' and 'scan_region' (slice or None),
+    'nbytes' of one record and 'apo_offset' and 'scan_offset' (byte offsets of the regions or None).
+    Data files with a @Type/@BytesPerPixel that is not in python_dtypes or without @SizeZ have 'dtype', 'shape'
+    and 'nbytes' None; they fail only when they are read (see check_OCTDataPlan).
+    handle can be any dict with the key 'Ocity' converted from Header.xml.
+    """
+    sign = handle['Ocity']['Instrument']['RawDataIsSigned'].replace('False','unsigned').replace('True','signed')
+    metadatas = handle['Ocity']['DataFiles']['DataFile']
+    if isinstance(metadatas, dict):
+        metadatas = [metadatas] # xmltodict returns a single DataFile not as a list
+
+    def region(metadata, name):
+        if metadata.get('@' + name + 'Start0'):
+            return slice(int(metadata['@' + name + 'Start0']), int(metadata['@' + name + 'End0']))
+        return None
+
+    data_files = {}
+    for metadata in metadatas:
+        name = metadata['#text'].replace('/', '\\').split('\\')[-1].split('.data')[0]
+        try:
+            dtype = get_OCTDtype(metadata.get('@Type'), metadata.get('@BytesPerPixel'), sign)
+            if metadata.get('@SizeX'):
+                shape = (int(metadata['@SizeX']), int(metadata['@SizeZ']))
+            else:
+                shape = (int(metadata['@SizeZ']),)
+        except (KeyError, ValueError):
+            dtype, shape = None, None # not needed unless this data file is read
+        match = re.fullmatch('Spectral([0-9]+)', name)
+        plan = {'name': name, 'filename': metadata['#text'], 'metadata': metadata,
+                'type': metadata.get('@Type'), 'dtype': dtype, 'shape': shape,
+                'index': int(match.group(1)) if match else None,
+                'apo_region': region(metadata, 'ApoRegion'), 'scan_region': region(metadata, 'ScanRegion'),
+                'nbytes': None if dtype is None else int(np.prod(shape)) * dtype.itemsize}
+        for key in ['apo', 'scan']:
+            rng = plan[key + '_region']
+            if rng is None or dtype is None:
+                plan[key + '_offset'] = None
+            else:
+                plan[key + '_offset'] = rng.start * int(np.prod(shape[1:])) * dtype.itemsize
+        data_files[metadata['#text']] = plan
+    return data_files
+
+def check_OCTDataPlan(plan):
+    """
+    Raise a ValueError if the data type or shape of the decode plan is unknown; returns plan.
+    """
+    if plan['dtype'] is None or plan['shape'] is None:
+        metadata = plan['metadata']
+        raise ValueError('Cannot decode {}: unknown @Type {} with @BytesPerPixel {} or missing @SizeZ.'.format(
+            plan['filename'], metadata.get('@Type'), metadata.get('@BytesPerPixel')))
+    return plan
+
+def get_OCTDataFiles(handle):
+    """
+    Return the compiled decode plans of all data files of handle (see compile_OCTHeader).
+    The plans are compiled only once and kept in handle['data_files'].
+    """
+    if handle.get('data_files') is None:
+        handle['data_files'] = compile_OCTHeader(handle)
+    return handle['data_files']
+
+def get_OCTDataFileProps(handle, data_name=None, prop=None):
+    """
+    List some of the properties as in the Header.xml.
+    """
+    return [plan['metadata'][prop] for name, plan in get_OCTDataFiles(handle).items() if data_name in name]
+
+def get_OCTFileMetaData(handle, data_name):
+    """
+    The metadata for files are store in a list.
+    The artifact 'data\\' stems from windows path separators and may need fixing.
+    """
+    data_files = get_OCTDataFiles(handle)
+    assert data_name in data_files, 'Did not find {}.\nAvailable names are: {}'.format(data_name,list(data_files))
+    return handle, data_files[data_name]['metadata']
+
+def get_OCTVideoImage(handle):
+    """
+    Examples how to extract VideoImage data
+    """
+    plan = get_OCTDataFiles(handle)['data\\VideoImage.data']
+    # This is not consistent! unsigned and signed not distinguished!
+    data = read_OCTData(handle, plan['filename'], plan['dtype']).reshape(plan['shape'])
+    data = abs(data)/abs(data).max()
+    return data
+
+def get_OCTIntensityImage(handle):
+    """
+    Example how to extract Intensity data
+    """
+    plan = get_OCTDataFiles(handle)['data\\Intensity.data'] # this is @Real
+    # there are two images. Read and take only the first [0].
+    data = (read_OCTData(handle, plan['filename'], dtype=(plan['dtype'], plan['shape']), count=1))[0].T
+    return data
+
+def get_OCTRealData(handle, data_name='data\\Chirp.data'):
+    """
+    Read a 1D data file of type Real, e.g. Chirp.data, OffsetErrors.data, or ApodizationSpectrum.data.
+    """
+    plan = get_OCTDataFiles(handle)[data_name]
+    return read_OCTData(handle, plan['filename'], dtype=plan['dtype'])
+
+def get_OCTSpectralRawFrame(handle, spec_name = 'Spectral0'):
+    """
+    Demo read raw spectral data.
+    Take note that we access all parameters using the decode plan compiled from Header.xml.
+    This should not require changes for different data.
+    """
+    handle, metadata = get_OCTFileMetaData(handle, data_name=spec_name) # check if spec_name exists
+    plan = get_OCTDataFiles(handle)[spec_name]
+
+    # select one [0] of two data frames
+    raw_data = read_OCTData(handle, plan['filename'], dtype=(plan['dtype'], plan['shape']), count=1)[0]
+    apo_data = None if plan['apo_region'] is None else raw_data[plan['apo_region']]
+    spec_data = raw_data if plan['scan_region'] is None else raw_data[plan['scan_region']]
+    # return also apodization data
+    return spec_data, apo_data
+
+class OCTVolume:
+    """
+    Lazy 3D view [y, x, z] of all Spectral data files in an OCT file.
+    Only the B-frames touched by an index are read and decoded, e.g. vol[y, x0:x1, :].
+    Recently decoded frames are kept in a LRU cache limited to cache_bytes.
+    Use np.asarray(vol) or vol[:] to obtain the full volume.
+
+    The frames are all Spectral data files with a scan region or without any apodization region,
+    ordered by the number n in Spectraln.data.
+    A Spectral0.data holding only apodization data is therefore not part of the volume.
+    """
+    def __init__(self, handle, cache_bytes=256*2**20):
+        self.handle = handle
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+
+        frames = []
+        for plan in get_OCTDataFiles(handle).values():
+            if plan['index'] is None:
+                continue
+            if plan['scan_region'] is None and plan['apo_region'] is not None:
+                continue # only apodization data
+            check_OCTDataPlan(plan)
+            scan_rng = plan['scan_region'] if plan['scan_region'] is not None else slice(0, plan['shape'][0])
+            frames.append((plan['index'], plan['filename'], plan['dtype'], plan['shape'], scan_rng))
+        assert len(frames) > 0, 'Did not find any Spectral data with a scan region.'
+        frames.sort(key=lambda f: f[0])
+
+        self.names = [f[1] for f in frames]
+        self._frames = frames
+        self.dtype = np.dtype(frames[0][2])
+        sizeX = frames[0][4].stop - frames[0][4].start
+        sizeZ = frames[0][3][1]
+        for f in frames:
+            assert (np.dtype(f[2]), f[4].stop - f[4].start, f[3][1]) == (self.dtype, sizeX, sizeZ), \
+                'Spectral data {} has a different shape or type.'.format(f[1])
+        self.shape = (len(frames), sizeX, sizeZ)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'OCTVolume(shape={}, dtype={})'.format(self.shape, self.dtype)
+
+    def get_frame(self, y):
+        """
+        Return the scan region of B-frame y and keep it in the cache.
+        """
+        if y in self._cache:
+            self._cache.move_to_end(y)
+            return self._cache[y]
+
+        frame = self.read_frame(y)
+        frame.flags.writeable = False # cached frames are shared
+
+        if frame.nbytes <= self.cache_bytes:
+            self._cache[y] = frame
+            self._cache_nbytes += frame.nbytes
+            while self._cache_nbytes > self.cache_bytes:
+                _, old_frame = self._cache.popitem(last=False)
+                self._cache_nbytes -= old_frame.nbytes
+        return frame
+
+    def read_frame(self, y, out=None):
+        """
+        Read the scan region of B-frame y from the file straight into out (default a new array) and return out.
+        Only the bytes of the scan region are copied, once; the cache is not used.
+        """
+        _, data_name, dtype, size_xz, scan_rng = self._frames[y]
+        if out is None:
+            out = np.empty(self.shape[1:], dtype=self.dtype)
+        offset = scan_rng.start * size_xz[1] * np.dtype(dtype).itemsize
+        if getattr(self, 'filename', None) is not None and self.handle.get('zipfile') is None:
+            # the process handle of an unpickled volume was closed (see get_OCTProcessHandle)
+            self.handle = get_OCTProcessHandle(self.filename)
+        readinto_OCTData(self.handle, data_name, [(offset, out)])
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 0 and key[0] is Ellipsis:
+            y_key, frame_key = slice(None), key
+        elif len(key) > 0:
+            y_key, frame_key = key[0], key[1:]
+        else:
+            y_key, frame_key = slice(None), ()
+
+        ys = np.arange(self.shape[0])[y_key]
+        if np.ndim(ys) == 0:
+            return self.get_frame(int(ys))[frame_key]
+
+        ys = ys.ravel()
+        if len(ys) == 0:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + frame_key]
+        first = self.get_frame(int(ys[0]))[frame_key]
+        out = np.empty((len(ys),) + first.shape, dtype=self.dtype)
+        out[0] = first
+        for n, y in enumerate(ys[1:], start=1):
+            out[n] = self.get_frame(int(y))[frame_key]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    def __iter__(self):
+        for y in range(self.shape[0]):
+            yield self.get_frame(y)
+
+    def __getstate__(self):
+        # pickle only the file name and the frame layout; the archive is opened again where it is used
+        state = dict(self.__dict__)
+        state['handle'] = None
+        state['filename'] = self.handle['filename'] if self.handle is not None else self.filename
+        state['_cache'] = OrderedDict()
+        state['_cache_nbytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.handle = get_OCTProcessHandle(self.filename)
+
+# The archives opened by unpickled OCTVolumes, one handle per process and file: (pid, path) -> (stamp, handle)
+_process_handles = OrderedDict()
+_process_handles_lock = threading.Lock()
+
+def get_OCTProcessHandle(filename, max_handles=None):
+    """
+    Return a handle of open_OCTFile for filename that is shared within the current process.
+    Forked processes open their own handle and a changed file is opened again; the handle of the
+    previous version is closed. At most max_handles (default OCT_process_handles) archives are kept open
+    and the least recently used one is closed first. Unpickled OCTVolumes reopen a closed handle when read.
+    """
+    if max_handles is None:
+        max_handles = OCT_process_handles
+    st = os.stat(filename)
+    key = (os.getpid(), os.path.abspath(filename))
+    stamp = (st.st_size, st.st_mtime_ns)
+    with _process_handles_lock:
+        entry = _process_handles.get(key)
+        if entry is not None and entry[0] == stamp:
+            _process_handles.move_to_end(key)
+            return entry[1]
+        if entry is not None:
+            close_OCTFile(entry[1]) # the file changed
+        handle = open_OCTFile(filename)
+        _process_handles[key] = (stamp, handle)
+        _process_handles.move_to_end(key)
+        while len(_process_handles) > max(1, max_handles):
+            _, (_, old_handle) = _process_handles.popitem(last=False)
+            close_OCTFile(old_handle)
+        return handle
+
+def get_OCTDaskArray(handle):
+    """
+    Return the OCTVolume of handle as dask array [y, x, z] with one B-frame per chunk. Requires the package dask.
+    Each chunk is read from the OCT file by its frame index when it is computed. The OCTVolume in the task graph
+    pickles only the file name, so the array works with the threaded, multiprocessing and distributed schedulers.
+    """
+    import dask.array as da
+    vol = OCTVolume(handle, cache_bytes=0)
+    st = os.stat(handle['filename'])
+    key = '{}:{}:{}'.format(os.path.abspath(handle['filename']), st.st_size, st.st_mtime_ns)
+    name = 'OCTVolume-' + hashlib.sha1(key.encode()).hexdigest()
+    return da.from_array(vol, chunks=(1,) + vol.shape[1:], name=name, lock=False, fancy=False, asarray=True)
+
+# The images with preview pyramids and the functions to get the full resolution image.
+pyramid_images = {'data\\Intensity.data': get_OCTIntensityImage,
+                  'data\\VideoImage.data': get_OCTVideoImage}
+
+def downsample_OCTImage(image):
+    """
+    Downsample an image by 2 with the mean of 2x2 pixels. Odd sizes repeat the last row or column.
+    """
+    if image.shape[0] % 2:
+        image = np.concatenate([image, image[-1:]], axis=0)
+    if image.shape[1] % 2:
+        image = np.concatenate([image, image[:, -1:]], axis=1)
+    return (image[0::2, 0::2] + image[1::2, 0::2] + image[0::2, 1::2] + image[1::2, 1::2]) / 4
+
+def build_OCTPyramids(handle, tile_size=256, cache_bytes=None):
+    """
+    Build the preview pyramids of Intensity and VideoImage in one pass and store them next to the cache.
+    Level 0 is the full image of get_OCTIntensityImage or get_OCTVideoImage as float32,
+    each further level is downsampled by 2 until the image fits into one tile.
+    The pyramids are an entry of the cache with their own size and last use (see list_OCTCache);
+    after building, the least recently used entries are removed if the cache has more than cache_bytes
+    (default OCT_cache_bytes).
+    Returns the pyramid folder.
+    """
+    if handle.get('pyramid_folder') is None:
+        handle['pyramid_folder'] = get_OCTPyramidFolder(get_OCTCacheFolder(handle['filename']))
+    folder = handle['pyramid_folder']
+    marker = os.path.join(folder, '.complete')
+    if os.path.exists(marker):
+        try:
+            os.utime(marker, ns=(time.time_ns(), time.time_ns())) # mark as recently used
+        except OSError:
+            pass # removed by a concurrent purge
+        return folder
+
+    # write into a separate folder and rename it when complete
+    partial_folder = '{}.partial-{}'.format(folder, os.getpid())
+    shutil.rmtree(partial_folder, ignore_errors=True)
+    os.makedirs(partial_folder)
+    levels = {}
+    for data_name, get_image in pyramid_images.items():
+        if data_name not in get_OCTDataFiles(handle):
+            continue
+        name = get_OCTDataFiles(handle)[data_name]['name']
+        with stage('decode') as st:
+            image = np.asarray(get_image(handle), dtype=np.float32)
+            st.nbytes = image.nbytes
+        levels[name] = []
+        while True:
+            np.save(os.path.join(partial_folder, '{}_{}.npy'.format(name, len(levels[name]))), image)
+            levels[name].append(list(image.shape))
+            if max(image.shape) <= tile_size:
+                break
+            image = downsample_OCTImage(image)
+    with open(os.path.join(partial_folder, '.complete'), 'w') as fid:
+        json.dump({'tile_size': tile_size, 'levels': levels, 'filename': os.path.abspath(handle['filename']),
+                   'bytes': get_FolderBytes(partial_folder)}, fid)
+    rename_OCTPartial(partial_folder, folder)
+    purge_OCTCache(OCT_cache_bytes if cache_bytes is None else cache_bytes,
+                   os.path.dirname(os.path.dirname(folder)), keep=(folder, handle.get('temp_oct_data_folder')))
+    return folder
+
+def get_OCTPreviewLevels(handle, data_name='data\\Intensity.data'):
+    """
+    Return the shapes of all levels of the preview pyramid of data_name. The pyramid is built if needed.
+    """
+    folder = build_OCTPyramids(handle)
+    with open(os.path.join(folder, '.complete')) as fid:
+        info = json.load(fid)
+    return [tuple(shape) for shape in info['levels'][get_OCTDataFiles(handle)[data_name]['name']]]
+
+def get_OCTPreview(handle, data_name='data\\Intensity.data', level=0, tile=None, tile_size=256):
+    """
+    Return level of the preview pyramid of Intensity.data or VideoImage.data, or only the tile (row, column).
+    A tile is tile_size x tile_size pixels or less at the edges.
+    The levels are memory-mapped, so only the pixels of a tile are read.
+    The pyramids are built when they are first requested for an OCT file.
+    """
+    folder = build_OCTPyramids(handle)
+    name = get_OCTDataFiles(handle)[data_name]['name']
+    image = np.load(os.path.join(folder, '{}_{}.npy'.format(name, level)), mmap_mode='r')
+    if tile is None:
+        return np.array(image)
+    row, column = tile
+    return np.array(image[row*tile_size:(row + 1)*tile_size, column*tile_size:(column + 1)*tile_size])
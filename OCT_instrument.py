@@ -0,0 +1,169 @@
+"""
+Per-stage timing and memory instrumentation of reading, converting, and processing OCT files.
+
+The stages are: 'zip open', 'header parse', 'extract', 'member read', 'decode',
+'dc removal', 'k-linearization', 'fft', and 'write'.
+For each stage the wall time, bytes processed and the peak of newly allocated memory are recorded.
+Nothing is recorded and the overhead is a single function call if no recorder or hook is active.
+
+Testing and usage example:
+
+import OCT_instrument, OCT_converter
+with OCT_instrument.record(memory=True) as rec:
+    OCT_converter.OCTtoNPYstream('test.oct')
+print(rec.summary())
+rec.to_json('test_stages.json')
+
+A hook is called with every record of a stage as it finishes:
+OCT_instrument.add_hook(lambda r: print(r['stage'], r['seconds']))
+"""
+import json
+import threading
+import time
+import tracemalloc
+
+_recorders = []
+_hooks = []
+_local = threading.local() # the stack of open stages of each thread
+
+class _NullStage:
+    """
+    Returned by stage() if instrumentation is disabled.
+    """
+    nbytes = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_null_stage = _NullStage()
+
+class Stage:
+    """
+    Context manager measuring one stage. Set nbytes if the number of bytes is only known inside the stage.
+    """
+    def __init__(self, name, nbytes=0):
+        self.name = name
+        self.nbytes = nbytes
+        self.memory = any(rec.memory for rec in _recorders) and tracemalloc.is_tracing()
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        if self.memory:
+            # reset_peak is global; keep the peak of the enclosing stages
+            current, peak = tracemalloc.get_traced_memory()
+            for outer in stack:
+                outer.peak = max(outer.peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory, self.peak = current, current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stack = _local.stack
+        stack.pop()
+        peak_bytes = None
+        if self.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            for outer in stack:
+                outer.peak = max(outer.peak, self.peak)
+            peak_bytes = self.peak - self.start_memory
+        record = {'stage': self.name, 'seconds': seconds, 'bytes': int(self.nbytes),
+                  'peak_bytes': peak_bytes, 'thread': threading.current_thread().name}
+        for rec in list(_recorders):
+            rec.records.append(record)
+        for hook in list(_hooks):
+            hook(record)
+        return False
+
+def stage(name, nbytes=0):
+    """
+    Measure the stage name as context manager: with stage('decode', nbytes=data.nbytes): ...
+    """
+    if not _recorders and not _hooks:
+        return _null_stage
+    return Stage(name, nbytes)
+
+def add_hook(hook):
+    """
+    Call hook(record) for every finished stage. A record is a dict with
+    'stage', 'seconds', 'bytes', 'peak_bytes' (None without memory tracing), and 'thread'.
+    """
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+class record:
+    """
+    Record all stages while active: with record(memory=True) as rec: ...
+    memory=True traces the allocated memory with tracemalloc which slows down the code.
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = []
+        self._started_tracing = False
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        _recorders.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _recorders.remove(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+        return False
+
+    def summary(self):
+        """
+        Aggregate the records per stage: count, seconds, bytes, MB/s, and the maximum peak_bytes.
+        """
+        stages = {}
+        for r in self.records:
+            s = stages.setdefault(r['stage'], {'count': 0, 'seconds': 0.0, 'bytes': 0, 'peak_bytes': None})
+            s['count'] += 1
+            s['seconds'] += r['seconds']
+            s['bytes'] += r['bytes']
+            if r['peak_bytes'] is not None:
+                s['peak_bytes'] = max(s['peak_bytes'] or 0, r['peak_bytes'])
+        for s in stages.values():
+            s['MB/s'] = s['bytes'] / s['seconds'] / 1e6 if s['seconds'] > 0 else None
+        return stages
+
+    def to_json(self, filename=None):
+        """
+        Return the summary and all records as JSON string and write it to filename if given.
+        """
+        text = json.dumps({'summary': self.summary(), 'records': self.records}, indent=1)
+        if filename is not None:
+            with open(filename, 'w') as fid:
+                fid.write(text)
+        return text
+
+def measure_allocations(fun, *args, repeat=10, warmup=2, **kwargs):
+    """
+    Return the largest peak of memory in bytes newly allocated during one of repeat calls of fun(*args, **kwargs)
+    after warmup calls, traced with tracemalloc (numpy arrays included).
+    A call that allocates no arrays measures only the few hundred bytes of its Python objects.
+    """
+    for _ in range(warmup):
+        fun(*args, **kwargs)
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        peak_bytes = 0
+        for _ in range(repeat):
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            fun(*args, **kwargs)
+            peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1] - start)
+        return peak_bytes
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
@@ -0,0 +1,572 @@
+"""
+Processing of the spectral data read with OCT_reader.
+
+The k-space linearization is computed once from Chirp.data as a resampling plan
+(index and weight arrays of the linear interpolation) and applied to batches of B-frames.
+The plan is cached on disk in the temp folder keyed by a hash of the chirp.
+
+Testing and usage example:
+
+from OCT_instrument import stage
+from OCT_core import open_OCTFile, OCTVolume, get_OCTRealData
+from OCT_processing import *
+handle = open_OCTFile('test.oct')
+plan = get_OCTResamplingPlan(get_OCTRealData(handle, 'data\\Chirp.data'))
+images = reconstruct_OCTFrames(plan, OCTVolume(handle)[0:10], dc=get_OCTBackground(handle))
+
+All B-frames of a volume can be reconstructed on several cores with
+images = reconstruct_volume(handle, workers=8)
+
+or iterated in order while the next frames are read in the background
+for image in iter_frames(handle, processed=True, prefetch=4): ...
+
+For many frames of the same shape an OCTProcessor reuses its working buffers
+processor = OCTProcessor(plan, frame.shape, dc=dc)
+image = processor.process(frame, out=image)
+"""
+import numpy as np
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from warnings import warn
+from OCT_instrument import stage
+from OCT_core import OCTVolume, get_OCTDataFiles, get_OCTProcessHandle, get_OCTRealData, get_OCTSpectralRawFrame, read_OCTData
+
+def get_OCTResamplingPlan(chirp_data, num_samples=None, cache_dir=None):
+    """
+    Create the plan to linearize the k-space of spectra with SizeZ = len(chirp_data).
+    This is equivalent to interp1d(x=chirp_data, y=spec)(np.arange(num_samples)).
+    Samples outside of the chirp range are set to the edge values.
+
+    The plan is a dict with the arrays 'index0', 'index1', 'weight'
+    and is saved in cache_dir (default $TMP/OCTData/plans) to be reused for all files with the same chirp.
+    """
+    chirp_data = np.asarray(chirp_data)
+    if num_samples is None:
+        num_samples = len(chirp_data)
+    chirp_hash = hashlib.sha1(chirp_data.dtype.str.encode() + chirp_data.tobytes()
+                              + str(num_samples).encode()).hexdigest()
+
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'OCTData', 'plans')
+    plan_file = os.path.join(cache_dir, chirp_hash + '.npz')
+    if os.path.exists(plan_file):
+        with np.load(plan_file) as plan_data:
+            plan = {k: plan_data[k] for k in plan_data.files}
+        plan.update({'num_samples': num_samples, 'chirp_hash': chirp_hash})
+        return plan
+
+    # linear interpolation between the neighbouring sorted chirp samples
+    order = np.argsort(chirp_data, kind='stable')
+    chirp_sorted = chirp_data[order].astype(np.float64)
+    k_lin = np.arange(num_samples, dtype=np.float64)
+    lo = np.clip(np.searchsorted(chirp_sorted, k_lin) - 1, 0, len(chirp_sorted) - 2)
+    weight = (k_lin - chirp_sorted[lo]) / (chirp_sorted[lo + 1] - chirp_sorted[lo])
+    plan = {'index0': order[lo].astype(np.intp),
+            'index1': order[lo + 1].astype(np.intp),
+            'weight': np.clip(weight, 0.0, 1.0)}
+
+    # write to a temporary file first so that other processes never read a partial plan
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = '{}.{}.tmp'.format(plan_file, os.getpid())
+    with open(tmp_file, 'wb') as fid:
+        np.savez(fid, **plan)
+    os.replace(tmp_file, plan_file)
+
+    plan.update({'num_samples': num_samples, 'chirp_hash': chirp_hash})
+    return plan
+
+# np.fft.rfft writes into a given out array since numpy 2.0
+_rfft_out = np.lib.NumpyVersion(np.__version__) >= '2.0.0'
+
+def linearize_OCTSpectra(plan, spec):
+    """
+    Linearize the k-space along the last axis of spec for any number of B-frames in one call.
+    The result has the float type of spec.
+    """
+    w = plan['weight'].astype(spec.dtype, copy=False)
+    return spec.take(plan['index0'], axis=-1) * (1 - w) + spec.take(plan['index1'], axis=-1) * w
+
+def reconstruct_OCTFrames(plan, spec, dc=None, log_scale=True, precision='float64'):
+    """
+    Reconstruct B-frames from spectral data: remove DC; k-space-lin; fft.
+    spec can be a single B-frame [x, z] or a batch [y, x, z] and dc is subtracted from each spectrum.
+    A real input fft is used and only the positive depths [0, num_samples//2) are returned.
+    The magnitude is scaled like abs(ifft(...)) and log_scale returns log10 of it.
+    precision 'float32' computes in float32/complex64 with half the memory bandwidth of 'float64'
+    (see validate_OCTPrecision for the deviation).
+    """
+    float_type = np.dtype(precision)
+    spec = np.asarray(spec) # convert lists or an OCTVolume only once
+    with stage('dc removal', nbytes=spec.nbytes):
+        spec = np.asarray(spec, dtype=float_type)
+        if dc is not None:
+            spec = spec - np.asarray(dc, dtype=float_type)
+    with stage('k-linearization', nbytes=spec.nbytes):
+        spec_lin = linearize_OCTSpectra(plan, spec)
+    with stage('fft', nbytes=spec_lin.nbytes):
+        # numpy >= 2 keeps float32 as complex64; older versions compute in complex128
+        spec_fft = np.abs(np.fft.rfft(spec_lin, axis=-1, norm='forward')[..., :plan['num_samples'] // 2])
+        spec_fft = spec_fft.astype(float_type, copy=False)
+        if log_scale:
+            spec_fft = np.log10(spec_fft)
+    return spec_fft
+
+def _iter_OCTFrames(data):
+    """
+    Iterate over the B-frames [x, z] of a single frame or a batch [y, x, z].
+    """
+    return (data,) if data.ndim == 2 else data
+
+class OCTProcessor:
+    """
+    Reconstruct B-frames of a fixed shape like reconstruct_OCTFrames with working buffers allocated once.
+    shape is the raw shape of one call, [x, z] or a batch [y, x, z]; smaller batches use the first frames of the buffers.
+    DC removal, k-linearization, fft, magnitude and log10 run in place or into the buffers, so process(spec, out)
+    allocates no arrays (numpy >= 2 for the fft into a buffer). Use OCT_instrument.measure_allocations to check.
+    """
+    def __init__(self, plan, shape, dc=None, log_scale=True, precision='float64'):
+        self.plan = plan
+        self.shape = tuple(shape)
+        self.log_scale = log_scale
+        self.dtype = np.dtype(precision)
+        self.index0, self.index1 = plan['index0'], plan['index1']
+        num_samples = len(self.index0)
+        lead = self.shape[:-1]
+        # dc and weights are repeated for all A-lines of one frame:
+        # in-place ufuncs with a broadcast operand allocate an iteration buffer on every call
+        frame_shape = self.shape[-2:]
+        self.dc = None if dc is None else np.broadcast_to(np.asarray(dc, dtype=self.dtype), frame_shape).copy()
+        weight = plan['weight'].astype(self.dtype)
+        self.weight1 = np.broadcast_to(weight, frame_shape[:-1] + (num_samples,)).copy()
+        self.weight0 = np.broadcast_to(1 - weight, frame_shape[:-1] + (num_samples,)).copy()
+        self.spec = np.empty(self.shape, dtype=self.dtype)
+        self.lin0 = np.empty(lead + (num_samples,), dtype=self.dtype)
+        self.lin1 = np.empty(lead + (num_samples,), dtype=self.dtype)
+        self.spec_fft = np.empty(lead + (num_samples // 2 + 1,), dtype=np.result_type(self.dtype, np.complex64))
+        self.magnitude = np.empty(lead + (num_samples // 2 + 1,), dtype=self.dtype)
+        self.out_shape = lead + (plan['num_samples'] // 2,)
+
+    def _buffers(self, n):
+        buffers = self.spec, self.lin0, self.lin1, self.spec_fft, self.magnitude
+        if len(self.shape) == 3 and n != self.shape[0]:
+            return [buffer[:n] for buffer in buffers]
+        return buffers
+
+    def process(self, spec, out=None):
+        """
+        Reconstruct spec into out (allocated if None) and return out.
+        """
+        spec_buf, lin0, lin1, spec_fft, magnitude = self._buffers(spec.shape[0])
+        if out is None:
+            out = np.empty(spec.shape[:-1] + self.out_shape[-1:], dtype=self.dtype)
+        with stage('dc removal', nbytes=spec.nbytes):
+            # convert first; a ufunc mixing the raw and float types would allocate casting buffers
+            np.copyto(spec_buf, spec, casting='unsafe')
+            if self.dc is not None:
+                for frame in _iter_OCTFrames(spec_buf):
+                    frame -= self.dc
+        with stage('k-linearization', nbytes=spec_buf.nbytes):
+            # mode='clip' avoids the buffered copy of mode='raise'; the plan indices are in range
+            np.take(spec_buf, self.index0, axis=-1, out=lin0, mode='clip')
+            np.take(spec_buf, self.index1, axis=-1, out=lin1, mode='clip')
+            for frame0, frame1 in zip(_iter_OCTFrames(lin0), _iter_OCTFrames(lin1)):
+                frame0 *= self.weight0
+                frame1 *= self.weight1
+            lin0 += lin1
+        with stage('fft', nbytes=lin0.nbytes):
+            if _rfft_out:
+                np.fft.rfft(lin0, axis=-1, norm='forward', out=spec_fft)
+            else:
+                spec_fft[...] = np.fft.rfft(lin0, axis=-1, norm='forward')
+            # the magnitude of the contiguous fft buffer avoids the buffered iteration over a strided view
+            np.abs(spec_fft, out=magnitude)
+            np.copyto(out, magnitude[..., :out.shape[-1]])
+            if self.log_scale:
+                np.log10(out, out=out)
+        return out
+
+def get_OCTApodizationMean(handle):
+    """
+    Mean spectrum of the apodization region of the first Spectral data file that has one.
+    get_OCTBackground averages the apodization regions of all Spectral data files.
+    """
+    plans = [plan for plan in get_OCTDataFiles(handle).values() if plan['index'] is not None and plan['apo_region'] is not None]
+    if len(plans) == 0:
+        raise KeyError('Did not find any Spectral data with an apodization region.')
+    plan = min(plans, key=lambda p: p['index'])
+    raw_data = read_OCTData(handle, plan['filename'], dtype=(plan['dtype'], plan['shape']), count=1)[0]
+    return np.mean(raw_data[plan['apo_region']], axis=0)
+
+class OCTBackground:
+    """
+    Background (DC) spectrum of the raw data estimated from apodization lines.
+    update(lines) adds lines [n, z] or a spectrum [z] to the running mean of all lines or,
+    with alpha, to the exponentially weighted mean over the updates (mean += alpha * (mean(lines) - mean)).
+    spectrum is the current model and is subtracted as dc from every frame of a batch.
+    """
+    def __init__(self, alpha=None):
+        self.alpha = alpha
+        self.count = 0
+        self.spectrum = None
+
+    def update(self, lines):
+        lines = np.asarray(lines, dtype=np.float64)
+        lines = lines.reshape(-1, lines.shape[-1])
+        mean = lines.mean(axis=0)
+        if self.spectrum is None:
+            self.spectrum = mean
+        elif self.alpha is None:
+            self.spectrum += (mean - self.spectrum) * (len(lines) / (self.count + len(lines)))
+        else:
+            self.spectrum += self.alpha * (mean - self.spectrum)
+        self.count += len(lines)
+        return self.spectrum
+
+def get_OCTBackground(handle, source='apodization', alpha=None):
+    """
+    Return the background spectrum [z] of the OCT file which is computed once and kept in the handle.
+    source='apodization' averages the apodization lines of all Spectral data files that have an apodization region
+    (running mean or with alpha exponentially weighted in the order of the files, see OCTBackground).
+    source='file' uses ApodizationSpectrum.data plus OffsetErrors.data if the file has it.
+    """
+    backgrounds = handle.setdefault('background', {})
+    key = (source, alpha)
+    if key in backgrounds:
+        return backgrounds[key]
+    data_files = get_OCTDataFiles(handle)
+    if source == 'file':
+        spectrum = get_OCTRealData(handle, 'data\\ApodizationSpectrum.data').astype(np.float64)
+        if 'data\\OffsetErrors.data' in data_files:
+            spectrum = spectrum + get_OCTRealData(handle, 'data\\OffsetErrors.data')
+    elif source == 'apodization':
+        plans = sorted((plan for plan in data_files.values() if plan['index'] is not None and plan['apo_region'] is not None),
+                       key=lambda p: p['index'])
+        if len(plans) == 0:
+            raise KeyError('Did not find any Spectral data with an apodization region.')
+        background = OCTBackground(alpha)
+        for plan in plans:
+            raw_data = read_OCTData(handle, plan['filename'], dtype=(plan['dtype'], plan['shape']), count=1)[0]
+            background.update(raw_data[plan['apo_region']])
+        spectrum = background.spectrum
+    else:
+        raise ValueError('Unknown background source {}'.format(source))
+    backgrounds[key] = spectrum
+    return spectrum
+
+def get_OCTSpectralImage(handle, spec_name='data\\Spectral0.data', plan=None, precision='float64'):
+    """
+    Reconstruct the log10 image [x, z] of one Spectral data file.
+    The DC is removed with the background of the file (see get_OCTBackground).
+    """
+    spec, _ = get_OCTSpectralRawFrame(handle, spec_name=spec_name)
+    if plan is None:
+        plan = get_OCTResamplingPlan(get_OCTRealData(handle, 'data\\Chirp.data'))
+    return reconstruct_OCTFrames(plan, spec, dc=get_OCTBackground(handle), precision=precision)
+
+def _get_reconstruct_state(vol, out, plan, dc, batch_size, precision):
+    """
+    The volume, output, batch buffer and OCTProcessor of one reconstruct_volume worker or call.
+    """
+    batch_size = min(batch_size, vol.shape[0])
+    raw = np.empty((batch_size,) + vol.shape[1:], dtype=vol.dtype)
+    return {'vol': vol, 'out': out, 'raw': raw, 'batch_size': batch_size,
+            'processor': OCTProcessor(plan, raw.shape, dc=dc, precision=precision)}
+
+def _reconstruct_range(state, y_rng):
+    """
+    Read the B-frames y_rng = (start, stop) into the batch buffer of state and reconstruct them into its output.
+    """
+    vol, raw, out, batch_size = state['vol'], state['raw'], state['out'], state['batch_size']
+    for y in range(y_rng[0], y_rng[1], batch_size):
+        y_end = min(y + batch_size, y_rng[1])
+        for n in range(y, y_end):
+            vol.read_frame(n, out=raw[n - y])
+        state['processor'].process(raw[:y_end - y], out=out[y:y_end])
+    return y_rng[1] - y_rng[0]
+
+# State of a worker process of reconstruct_volume set by _init_reconstruct_worker
+_worker = {}
+
+def _init_reconstruct_worker(filename, out_name, out_shape, plan, dc, batch_size, precision):
+    """
+    Attach the worker process to the shared memory block of reconstruct_volume.
+    The plan and dc are passed once per process and not with every task.
+    Each worker process opens its own handle of the file, as forked processes must not share the open archive.
+    """
+    _worker['shm_out'] = shared_memory.SharedMemory(name=out_name)
+    out = np.ndarray(out_shape, dtype=precision, buffer=_worker['shm_out'].buf)
+    vol = OCTVolume(get_OCTProcessHandle(filename), cache_bytes=0)
+    _worker.update(_get_reconstruct_state(vol, out, plan, dc, batch_size, precision))
+
+def _reconstruct_frames(y_rng):
+    """
+    Reconstruct the B-frames y_rng = (start, stop) in a worker process.
+    """
+    return _reconstruct_range(_worker, y_rng)
+
+def reconstruct_volume(handle, workers=None, batch_size=8, plan=None, dc=None, precision='float64', out=None):
+    """
+    Reconstruct all B-frames of the OCTVolume of handle as log10 images [y, x, z] using a process pool.
+    Each worker reads and decompresses its own B-frames and writes the images into a
+    multiprocessing.shared_memory block, so neither frames nor images are pickled.
+    The images are copied from the shared block into out (default a new array) at the end,
+    so the peak memory is twice the size of the images; workers=1 reconstructs straight into out.
+    workers defaults to os.cpu_count(); workers=1 runs in the calling process.
+    precision is the float type of the processing and the images (see reconstruct_OCTFrames).
+    """
+    vol = OCTVolume(handle, cache_bytes=0)
+    if plan is None:
+        plan = get_OCTResamplingPlan(get_OCTRealData(handle, 'data\\Chirp.data'))
+    if dc is None:
+        dc = get_OCTBackground(handle)
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, min(workers, vol.shape[0]))
+    out_shape = vol.shape[:2] + (plan['num_samples'] // 2,)
+    if out is None:
+        out = np.empty(out_shape, dtype=precision)
+    elif out.shape != out_shape or out.dtype != np.dtype(precision):
+        raise ValueError('out must be an array {} of {}'.format(out_shape, np.dtype(precision)))
+
+    # a few chunks per worker to balance the load
+    bounds = np.linspace(0, vol.shape[0], min(vol.shape[0], workers * 4) + 1).astype(int)
+    chunks = [(y0, y1) for y0, y1 in zip(bounds[:-1], bounds[1:]) if y1 > y0]
+    if workers == 1:
+        # the state is local to the call, so several threads can reconstruct at the same time
+        state = _get_reconstruct_state(vol, out, plan, dc, batch_size, precision)
+        for y_rng in chunks:
+            _reconstruct_range(state, y_rng)
+        return out
+
+    shm_out = shared_memory.SharedMemory(create=True, size=max(1, out.nbytes))
+    try:
+        initargs = (handle['filename'], shm_out.name, out_shape, plan, dc, batch_size, precision)
+        with multiprocessing.Pool(workers, initializer=_init_reconstruct_worker, initargs=initargs) as pool:
+            list(pool.imap_unordered(_reconstruct_frames, chunks))
+        out[...] = np.ndarray(out_shape, dtype=precision, buffer=shm_out.buf)
+    finally:
+        shm_out.close()
+        shm_out.unlink()
+    return out
+
+def iter_frames(handle, processed=True, prefetch=4, frames=None, plan=None, dc=None, precision='float64', log_scale=True):
+    """
+    Yield the B-frames of the OCTVolume of handle in order, raw [x, z] or reconstructed as log10 image
+    (or the magnitude with log_scale=False).
+    A pool of prefetch threads reads, decompresses, and reconstructs the next frames
+    while the caller works on the current one.
+    At most prefetch frames are pending; closing the generator (or leaving a for loop) cancels them.
+    frames selects the B-frames like an index, e.g. frames=slice(0, 100, 2).
+    precision is the float type of the reconstruction (see reconstruct_OCTFrames).
+    """
+    vol = OCTVolume(handle, cache_bytes=0) # no shared cache between the threads
+    ys = np.arange(vol.shape[0]) if frames is None else np.arange(vol.shape[0])[frames].ravel()
+    if processed and plan is None:
+        plan = get_OCTResamplingPlan(get_OCTRealData(handle, 'data\\Chirp.data'))
+    if processed and dc is None:
+        dc = get_OCTBackground(handle)
+
+    local = threading.local() # one OCTProcessor per thread
+
+    def load_frame(y):
+        frame = vol.get_frame(int(y))
+        if processed:
+            if getattr(local, 'processor', None) is None:
+                local.processor = OCTProcessor(plan, frame.shape, dc=dc, log_scale=log_scale, precision=precision)
+            return local.processor.process(frame)
+        return frame
+
+    pool = ThreadPoolExecutor(max_workers=max(1, prefetch), thread_name_prefix='iter_frames')
+    pending = deque()
+    try:
+        next_y = iter(ys)
+        for y in next_y:
+            pending.append(pool.submit(load_frame, y))
+            if len(pending) >= max(1, prefetch):
+                break
+        while pending:
+            frame = pending.popleft().result()
+            for y in next_y:
+                pending.append(pool.submit(load_frame, y))
+                break
+            yield frame
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+def _reconstruct_block(block, plan, dc, log_scale, precision):
+    """
+    Reconstruct one chunk of B-frames for reconstruct_dask.
+    """
+    return reconstruct_OCTFrames(plan, block, dc=dc, log_scale=log_scale, precision=precision)
+
+def reconstruct_dask(volume, plan, dc=None, log_scale=True, precision='float64'):
+    """
+    Reconstruct a dask array of raw B-frames [y, x, z], e.g. of OCT_core.get_OCTDaskArray, with map_blocks.
+    Returns a lazy dask array of the images [y, x, z//2] with the same chunks along y,
+    which runs on any dask scheduler, e.g. images.compute(scheduler='processes').
+    """
+    if volume.numblocks[1:] != (1, 1):
+        volume = volume.rechunk({1: -1, 2: -1})
+    depth = plan['num_samples'] // 2
+    return volume.map_blocks(_reconstruct_block, plan, dc, log_scale, precision,
+                             chunks=volume.chunks[:2] + ((depth,),), dtype=np.dtype(precision))
+
+def validate_OCTPrecision(handle, precision='float32', frames=None, plan=None, dc=None):
+    """
+    Compare the reconstruction with precision against float64 for the B-frames of handle (default all).
+    Returns a dict with the maximum and mean absolute deviation in dB (20*log10 of the magnitude)
+    and the number of frames compared. Pixels with zero magnitude in either result are ignored.
+    """
+    if plan is None:
+        plan = get_OCTResamplingPlan(get_OCTRealData(handle, 'data\\Chirp.data'))
+    if dc is None:
+        dc = get_OCTBackground(handle)
+    vol = OCTVolume(handle, cache_bytes=0)
+    ys = np.arange(vol.shape[0]) if frames is None else np.arange(vol.shape[0])[frames].ravel()
+    max_dB, sum_dB, count = 0.0, 0.0, 0
+    for y in ys:
+        frame = vol.get_frame(int(y))
+        image64 = reconstruct_OCTFrames(plan, frame, dc=dc, precision='float64')
+        image = reconstruct_OCTFrames(plan, frame, dc=dc, precision=precision)
+        deviation = 20 * np.abs(image.astype(np.float64) - image64)
+        deviation = deviation[np.isfinite(deviation)]
+        if deviation.size:
+            max_dB = max(max_dB, float(deviation.max()))
+            sum_dB += float(deviation.sum())
+            count += deviation.size
+    return {'precision': precision, 'max_dB': max_dB, 'mean_dB': sum_dB / max(count, 1), 'frames': len(ys)}
+
+class OCTHistogram:
+    """
+    Histogram with a fixed number of bins over value_range to estimate percentiles of many frames in one streaming pass.
+    The default range covers the log10 magnitude of the reconstruction; values outside count in the first or last bin.
+    Non-finite values are ignored. The percentiles are exact to the bin width (value_range / bins).
+    """
+    def __init__(self, bins=2**14, value_range=(-8.0, 8.0)):
+        self.edges = np.linspace(value_range[0], value_range[1], bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def add(self, values):
+        values = np.asarray(values).ravel()
+        values = values[np.isfinite(values)]
+        index = np.searchsorted(self.edges, values, side='right') - 1
+        np.clip(index, 0, len(self.counts) - 1, out=index)
+        self.counts += np.bincount(index, minlength=len(self.counts))
+
+    def percentile(self, q):
+        """
+        Return the percentiles q (0..100) interpolated linearly within the bins.
+        """
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        if cumulative[-1] == 0:
+            raise ValueError('The histogram is empty.')
+        return np.interp(np.asarray(q, dtype=np.float64) / 100 * cumulative[-1], cumulative, self.edges)
+
+class EnFaceProjector:
+    """
+    Accumulate en-face projections [y, x] from reconstructed B-frames [x, z] added one at a time.
+    depth_ranges maps a name to a slice of depth pixels (default {'all': slice(None)}),
+    e.g. {'all': slice(None), 'retina': slice(100, 300)}.
+    For each depth range and mode ('mean', 'max', 'min') one array [y, x] is kept, i.e. the memory is O(X*Y).
+    A frame can be added to the same y several times, e.g. repeated B-scans, and is combined with the previous ones.
+    """
+    def __init__(self, shape, depth_ranges=None, modes=('mean', 'max', 'min'), dtype=np.float64):
+        self.shape = tuple(shape)
+        self.depth_ranges = depth_ranges or {'all': slice(None)}
+        self.modes = tuple(modes)
+        self.count = np.zeros(self.shape[0], dtype=np.int64)
+        initial = {'mean': 0, 'max': -np.inf, 'min': np.inf}
+        self.projections = {name: {mode: np.full(self.shape, initial[mode], dtype=dtype) for mode in self.modes}
+                            for name in self.depth_ranges}
+
+    def add(self, y, frame):
+        for name, depth in self.depth_ranges.items():
+            sub = frame[:, depth]
+            projection = self.projections[name]
+            if 'mean' in projection:
+                projection['mean'][y] += sub.mean(axis=-1)
+            if 'max' in projection:
+                np.maximum(projection['max'][y], sub.max(axis=-1), out=projection['max'][y])
+            if 'min' in projection:
+                np.minimum(projection['min'][y], sub.min(axis=-1), out=projection['min'][y])
+        self.count[y] += 1
+
+    def result(self):
+        """
+        Return {name: {mode: [y, x]}} for all depth ranges and modes. Rows y without frames are nan.
+        """
+        missing = self.count == 0
+        result = {}
+        for name, projection in self.projections.items():
+            result[name] = {}
+            for mode, image in projection.items():
+                image = image / np.maximum(self.count, 1)[:, None] if mode == 'mean' else image.copy()
+                image[missing] = np.nan
+                result[name][mode] = image
+        return result
+
+class BScanAverager:
+    """
+    Average each repeats consecutive B-frames (repeated B-scans at the same position).
+    add returns the average after the last repeat of a position and None otherwise.
+    Only the sum of one frame is kept in memory.
+    """
+    def __init__(self, repeats):
+        self.repeats = repeats
+        self.sum = None
+        self.count = 0
+
+    def add(self, frame):
+        if self.count == 0:
+            self.sum = np.array(frame, dtype=np.result_type(frame, np.float32))
+        else:
+            self.sum += frame
+        self.count += 1
+        if self.count < self.repeats:
+            return None
+        self.count = 0
+        return self.sum / self.repeats
+
+def get_OCTEnFace(handle, depth_ranges=None, modes=('mean', 'max', 'min'), repeats=1, log_scale=True,
+                  prefetch=4, plan=None, dc=None, precision='float64'):
+    """
+    Compute en-face projections [y, x] of a Mode3D file in one streaming pass over the B-frames
+    without keeping the reconstructed volume (see EnFaceProjector for depth_ranges and modes).
+    With repeats > 1 each repeats consecutive B-frames are averaged first and y is the index of the position;
+    trailing B-frames that do not complete a position are skipped with a warning.
+    The projections and averages use the magnitude; log_scale returns log10 of the projections.
+    Returns {name: {mode: [y, x]}}.
+    """
+    num_frames = OCTVolume(handle, cache_bytes=0).shape[0]
+    if not 1 <= repeats <= num_frames:
+        raise ValueError('repeats must be between 1 and the number of B-frames {}, not {}'.format(num_frames, repeats))
+    num_positions = num_frames // repeats
+    if num_frames % repeats:
+        warn('The last {} of {} B-frames do not complete a position of {} repeats and are skipped.'.format(
+            num_frames % repeats, num_frames, repeats))
+    projector = None
+    averager = BScanAverager(repeats)
+    y = 0
+    for frame in iter_frames(handle, prefetch=prefetch, frames=slice(0, num_positions * repeats), plan=plan, dc=dc,
+                             precision=precision, log_scale=False):
+        frame = averager.add(frame)
+        if frame is None:
+            continue
+        if projector is None:
+            projector = EnFaceProjector((num_positions, frame.shape[0]), depth_ranges, modes, dtype=frame.dtype)
+        projector.add(y, frame)
+        y += 1
+    result = projector.result()
+    if log_scale:
+        for projection in result.values():
+            for mode in projection:
+                projection[mode] = np.log10(projection[mode])
+    return result
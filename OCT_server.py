@@ -0,0 +1,291 @@
+"""
+A small HTTP server to view OCT files of a local directory without copying them.
+
+Usage:
+python OCT_server.py <directory> --port 8000 --cache-bytes 1000000000 [--catalog catalog.sqlite]
+
+The files are addressed by their path relative to <directory>. All images are returned as PNG (default)
+or with format=npy as npy file (np.load(io.BytesIO(response))) in the data type of the Python functions.
+GET /files                              list of the OCT files (of the catalog if given, see OCT_catalog)
+GET /header/<file>                      JSON with the data files, their shapes and types, and the volume shape
+GET /raw/<file>?y=0                     raw spectral B-frame [x, z]
+GET /bscan/<file>?y=0                   reconstructed log10 B-scan [x, z]
+GET /intensity/<file>?level=0           Intensity preview level (see get_OCTPreview)
+GET /video/<file>?level=0               VideoImage preview level
+GET /enface/<file>?z0=0&z1=100&mode=max en-face projection [y, x] of the log10 magnitude over the depths [z0, z1)
+All images accept tile=<row>,<column> and tile_size=256 to return one tile only.
+PNG images are scaled to 8 bit from vmin to vmax (default the 0.5 and 99.5 percentiles); B-scans are shown with depth down.
+
+Reconstructed B-scans and en-face images are kept in one LRU cache of --cache-bytes shared by all requests.
+Concurrent requests for the same image wait for the first one instead of computing it again.
+"""
+import argparse
+import io
+import json
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+import numpy as np
+from OCT_core import OCTVolume, build_OCTPyramids, get_OCTDataFiles, get_OCTPreview, get_OCTRealData, open_OCTFile
+from OCT_processing import get_OCTBackground, get_OCTEnFace, get_OCTResamplingPlan, reconstruct_OCTFrames
+
+class OCTImageCache:
+    """
+    LRU cache of arrays limited to max_bytes, safe to use from several threads.
+    get(key, compute) returns the cached value or calls compute() once; concurrent callers
+    of the same key wait for the result of the first caller (request coalescing).
+    Values that are not arrays count with 0 bytes.
+    """
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = self.pending[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = compute()
+        except BaseException as e:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.pending[key]
+            nbytes = getattr(value, 'nbytes', 0)
+            if nbytes <= self.max_bytes:
+                self.items[key] = value
+                self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    _, old = self.items.popitem(last=False)
+                    self.nbytes -= getattr(old, 'nbytes', 0)
+        future.set_result(value)
+        return value
+
+def encode_PNG(image):
+    """
+    Encode a uint8 image [rows, columns] (gray) or [rows, columns, 3] (RGB) as PNG with zlib.
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    color_type = 2 if image.ndim == 3 else 0
+    # each row starts with the filter type 0 (None)
+    rows = np.zeros((height, 1 + image[0].size), dtype=np.uint8)
+    rows[:, 1:] = image.reshape(height, -1)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) +
+            chunk(b'IEND', b''))
+
+def scale_OCTImage(image, vmin=None, vmax=None):
+    """
+    Scale image linearly from vmin..vmax to uint8. The default range are the 0.5 and 99.5 percentiles of the finite pixels.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    if vmin is None or vmax is None:
+        finite = image[np.isfinite(image)]
+        low, high = np.percentile(finite, [0.5, 99.5]) if finite.size else (0, 1)
+        vmin = low if vmin is None else vmin
+        vmax = high if vmax is None else vmax
+    scaled = (image - vmin) * (255 / max(vmax - vmin, np.finfo(np.float32).tiny))
+    return np.clip(np.nan_to_num(scaled, nan=0, posinf=255, neginf=0), 0, 255).astype(np.uint8)
+
+def encode_NPY(data):
+    """
+    Return the bytes of an npy file of data.
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(data), allow_pickle=False)
+    return buffer.getvalue()
+
+class OCTServer:
+    """
+    The OCT files below root, their open handles, and the image cache of the HTTP handler.
+    """
+    def __init__(self, root, cache_bytes=2**30, catalog=None):
+        self.root = os.path.realpath(root)
+        self.catalog = catalog
+        self.cache = OCTImageCache(cache_bytes)
+        self.handles = {}
+        self.lock = threading.Lock()
+
+    def list_files(self):
+        if self.catalog is not None:
+            from OCT_catalog import query_OCTCatalog
+            paths = [row['path'] for row in query_OCTCatalog(self.catalog) if row['error'] is None]
+        else:
+            from OCT_batch import find_OCTFiles
+            paths = find_OCTFiles(self.root)
+        paths = [os.path.relpath(path, self.root) for path in paths]
+        return [path.replace(os.sep, '/') for path in paths if not path.startswith('..')]
+
+    def get_path(self, name):
+        """
+        Resolve a file name relative to root; names outside of root are rejected.
+        """
+        path = os.path.realpath(os.path.join(self.root, name))
+        if not path.startswith(os.path.join(self.root, '')) or not path.lower().endswith('.oct') or not os.path.isfile(path):
+            raise FileNotFoundError(name)
+        return path
+
+    def get_handle(self, name):
+        """
+        Return the handle of open_OCTFile with the OCTVolume in handle['volume'], opened once per file.
+        """
+        path = self.get_path(name)
+
+        def open_file():
+            handle = open_OCTFile(path)
+            handle['volume'] = OCTVolume(handle, cache_bytes=0)
+            return handle
+
+        # coalesce concurrent opens of the same file; handles are not counted in the budget
+        with self.lock:
+            handle = self.handles.get(path)
+        if handle is None:
+            handle = self.cache.get(('handle', path), open_file)
+            with self.lock:
+                self.handles.setdefault(path, handle)
+        return handle
+
+    def get_processing(self, name):
+        handle = self.get_handle(name)
+        return self.cache.get(('processing', handle['filename']), lambda: (
+            get_OCTResamplingPlan(get_OCTRealData(handle, 'data\\Chirp.data')), get_OCTBackground(handle)))
+
+    def get_header(self, name):
+        handle = self.get_handle(name)
+        data_files = {data_name: {'name': plan['name'], 'dtype': str(plan['dtype']), 'shape': plan['shape']}
+                      for data_name, plan in get_OCTDataFiles(handle).items()}
+        return {'file': name, 'volume_shape': handle['volume'].shape, 'data_files': data_files}
+
+    def get_raw(self, name, y):
+        return self.get_handle(name)['volume'].get_frame(y)
+
+    def get_bscan(self, name, y):
+        handle = self.get_handle(name)
+
+        def reconstruct():
+            plan, dc = self.get_processing(name)
+            return reconstruct_OCTFrames(plan, handle['volume'].get_frame(y), dc=dc, precision='float32')
+
+        return self.cache.get(('bscan', handle['filename'], y), reconstruct)
+
+    def get_preview(self, name, data_name, level):
+        handle = self.get_handle(name)
+        # build the pyramids only once per file
+        self.cache.get(('pyramid', handle['filename']), lambda: build_OCTPyramids(handle))
+        return get_OCTPreview(handle, data_name, level)
+
+    def get_enface(self, name, z0, z1, mode):
+        if mode not in ('mean', 'max', 'min'):
+            raise ValueError('Unknown en-face mode {}; use mean, max or min'.format(mode))
+        handle = self.get_handle(name)
+        plan, _ = self.get_processing(name)
+        if len(range(plan['num_samples'] // 2)[z0:z1]) == 0:
+            raise ValueError('Empty depth range z0={} z1={} of {} depths'.format(z0, z1, plan['num_samples'] // 2))
+
+        def project():
+            plan, dc = self.get_processing(name)
+            enface = get_OCTEnFace(handle, {'range': slice(z0, z1)}, modes=(mode,), plan=plan, dc=dc, precision='float32')
+            return enface['range'][mode]
+
+        return self.cache.get(('enface', handle['filename'], z0, z1, mode), project)
+
+def make_OCTRequestHandler(server):
+    """
+    Return the BaseHTTPRequestHandler class serving the files of the OCTServer server.
+    """
+    class OCTRequestHandler(BaseHTTPRequestHandler):
+        def send_content(self, body, content_type, status=200):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_image(self, image, query, transpose=False):
+            if 'tile' in query:
+                row, column = (int(v) for v in query['tile'].split(','))
+                tile_size = int(query.get('tile_size', 256))
+                image = image[row*tile_size:(row + 1)*tile_size, column*tile_size:(column + 1)*tile_size]
+            if query.get('format', 'png') == 'npy':
+                return self.send_content(encode_NPY(image), 'application/octet-stream')
+            vmin = float(query['vmin']) if 'vmin' in query else None
+            vmax = float(query['vmax']) if 'vmax' in query else None
+            image = scale_OCTImage(image, vmin, vmax)
+            self.send_content(encode_PNG(image.T if transpose else image), 'image/png')
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            kind, _, name = unquote(url.path).lstrip('/').partition('/')
+            try:
+                if kind == 'files':
+                    return self.send_content(json.dumps(server.list_files()).encode(), 'application/json')
+                if kind == 'header':
+                    return self.send_content(json.dumps(server.get_header(name)).encode(), 'application/json')
+                if kind == 'raw':
+                    return self.send_image(server.get_raw(name, int(query.get('y', 0))), query, transpose=True)
+                if kind == 'bscan':
+                    return self.send_image(server.get_bscan(name, int(query.get('y', 0))), query, transpose=True)
+                if kind in ('intensity', 'video'):
+                    data_name = 'data\\Intensity.data' if kind == 'intensity' else 'data\\VideoImage.data'
+                    return self.send_image(server.get_preview(name, data_name, int(query.get('level', 0))), query)
+                if kind == 'enface':
+                    z0 = int(query['z0']) if 'z0' in query else None
+                    z1 = int(query['z1']) if 'z1' in query else None
+                    return self.send_image(server.get_enface(name, z0, z1, query.get('mode', 'mean')), query)
+                self.send_error(404, 'Unknown request {}'.format(kind))
+            except (FileNotFoundError, KeyError, IndexError) as e:
+                self.send_error(404, '{}: {}'.format(type(e).__name__, e))
+            except ValueError as e:
+                self.send_error(400, '{}: {}'.format(type(e).__name__, e))
+            except Exception as e:
+                self.send_error(500, '{}: {}'.format(type(e).__name__, e))
+
+    return OCTRequestHandler
+
+def serve_OCTFiles(root, host='127.0.0.1', port=8000, cache_bytes=2**30, catalog=None):
+    """
+    Serve the OCT files below root until interrupted.
+    """
+    server = OCTServer(root, cache_bytes, catalog)
+    httpd = ThreadingHTTPServer((host, port), make_OCTRequestHandler(server))
+    print('Serving {} on http://{}:{}/files'.format(server.root, host, httpd.server_address[1]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-bytes', type=int, default=2**30)
+    parser.add_argument('--catalog', default=None, help='SQLite catalog of OCT_catalog.py to list the files')
+    args = parser.parse_args()
+    serve_OCTFiles(args.directory, args.host, args.port, args.cache_bytes, args.catalog)
@@ -0,0 +1,117 @@
+"""
+Write synthetic Thorlabs OCT files for testing and benchmarking without real data.
+
+Testing and usage example:
+
+import OCT_synthetic
+OCT_synthetic.write_synthetic_OCTFile('synthetic.oct', size_x=512, size_z=1024, size_y=10)
+
+The Spectral data contain a few tilted reflecting layers, a Gaussian source spectrum, and noise.
+The spectra are sampled at the positions of Chirp.data, so the layers appear as sharp lines
+only after k-space linearization.
+"""
+import numpy as np
+import xmltodict
+import zipfile
+
+def get_synthetic_Chirp(size_z):
+    """
+    A smooth, monotonic, non-linear chirp: sample i of a spectrum is at linear k = chirp[i].
+    """
+    i = np.arange(size_z, dtype=np.float64)
+    chirp = i + 0.02 * size_z * np.sin(np.pi * i / (size_z - 1))
+    return chirp.astype(np.float32)
+
+def get_synthetic_Spectra(chirp, size_x, y=0, size_y=1, dtype=np.uint16, apo=False, seed=0):
+    """
+    Return synthetic raw spectra [size_x, size_z] of B-frame y.
+    With apo=True the spectra contain no reflections (apodization data).
+    """
+    rng = np.random.default_rng([seed, y, int(apo)])
+    size_z = len(chirp)
+    k = chirp.astype(np.float64)[None, :]
+    source = np.exp(-0.5 * ((k - size_z / 2) / (size_z / 5))**2)
+    fringes = np.zeros((size_x, size_z))
+    if not apo:
+        x = np.arange(size_x)[:, None] / size_x
+        for depth, tilt, amplitude in [(0.10, 0.05, 0.30), (0.25, -0.03, 0.15), (0.40, 0.02, 0.08)]:
+            z = size_z * (depth + tilt * (x + y / max(size_y, 1)))
+            fringes += amplitude * np.cos(2 * np.pi * z * k / size_z)
+    spectra = source * (1 + fringes) + 0.01 * rng.standard_normal((size_x, size_z))
+
+    # scale into the range of the raw data type
+    info = np.iinfo(dtype)
+    offset = 0 if info.min < 0 else (info.max + 1) // 4
+    spectra = offset + spectra * (info.max - offset) * 0.4
+    return np.clip(np.round(spectra), info.min, info.max).astype(dtype)
+
+def write_synthetic_OCTFile(filename, size_x=256, size_z=512, size_y=1, bytes_per_pixel=2, signed=False,
+                            spectral0_apo_only=False, apo_lines=25, compression=zipfile.ZIP_STORED,
+                            model='Synthetic', comment='synthetic data', seed=0):
+    """
+    Write a synthetic OCT file with Header.xml and the data files
+    Spectral*.data, Chirp.data, OffsetErrors.data, ApodizationSpectrum.data, Intensity.data, VideoImage.data.
+
+    size_y is the number of B-frames with scan data.
+    If spectral0_apo_only is False, Spectral0.data has apo_lines apodization lines followed by the scan region.
+    If spectral0_apo_only is True, Spectral0.data contains only apodization data and the B-frames are
+    Spectral1.data ... Spectral<size_y>.data.
+    All other Spectral data have only a scan region.
+    bytes_per_pixel (1 or 2) and signed select the raw data type.
+    compression can be zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED.
+    """
+    raw_dtype = np.dtype('{}{}'.format('i' if signed else 'u', bytes_per_pixel))
+    chirp = get_synthetic_Chirp(size_z)
+    range_x, range_z = 5.0, 2.5 # mm
+
+    data_files = []
+    def add_data_file(name, data, **attributes):
+        attrs = {'@' + k: str(v) for k, v in attributes.items()}
+        attrs['#text'] = 'data\\{}.data'.format(name)
+        data_files.append((attrs, np.ascontiguousarray(data).tobytes()))
+
+    raw_attrs = {'Type': 'Raw', 'SizeZ': size_z, 'BytesPerPixel': bytes_per_pixel, 'RangeX': range_x, 'RangeZ': range_z}
+    apo_data = get_synthetic_Spectra(chirp, apo_lines, dtype=raw_dtype, apo=True, seed=seed)
+    if spectral0_apo_only:
+        add_data_file('Spectral0', apo_data, SizeX=apo_lines, ApoRegionStart0=0, ApoRegionEnd0=apo_lines, **raw_attrs)
+        first_frame = 1
+    else:
+        spectral0 = np.concatenate([apo_data, get_synthetic_Spectra(chirp, size_x, 0, size_y, raw_dtype, seed=seed)])
+        add_data_file('Spectral0', spectral0, SizeX=apo_lines + size_x, ApoRegionStart0=0, ApoRegionEnd0=apo_lines,
+                      ScanRegionStart0=apo_lines, ScanRegionEnd0=apo_lines + size_x, **raw_attrs)
+        first_frame = 1
+        size_y -= 1
+    for n in range(first_frame, first_frame + size_y):
+        y = n - 1 if spectral0_apo_only else n
+        add_data_file('Spectral{}'.format(n), get_synthetic_Spectra(chirp, size_x, y, size_y, raw_dtype, seed=seed),
+                      SizeX=size_x, ScanRegionStart0=0, ScanRegionEnd0=size_x, **raw_attrs)
+    last_frame = first_frame + size_y - 1
+
+    real_attrs = {'Type': 'Real', 'BytesPerPixel': 4}
+    add_data_file('Chirp', chirp, SizeZ=size_z, **real_attrs)
+    add_data_file('OffsetErrors', np.zeros(size_z, dtype=np.float32), SizeZ=size_z, **real_attrs)
+    add_data_file('ApodizationSpectrum', apo_data.mean(axis=0).astype(np.float32), SizeZ=size_z, **real_attrs)
+
+    # two intensity images [x, z] and a video image
+    rng = np.random.default_rng(seed)
+    intensity = 40 + 10 * rng.random((2, size_x, size_z // 2)).astype(np.float32)
+    add_data_file('Intensity', intensity, SizeX=size_x, SizeZ=size_z // 2, RangeX=range_x, RangeZ=range_z, **real_attrs)
+    video = rng.integers(0, 2**24, (size_x, size_x), dtype=np.int32)
+    add_data_file('VideoImage', video, Type='Colored', SizeX=size_x, SizeZ=size_x, BytesPerPixel=4)
+
+    size_pixel = {'SizeX': str(size_x), 'SizeZ': str(size_z)}
+    if last_frame > 0:
+        size_pixel['SizeY'] = str(last_frame) # the converters allocate SizeY + 1 frames
+    header = {'Ocity': {
+        'Instrument': {'Model': model, 'RawDataIsSigned': str(bool(signed)),
+                       'BinaryToElectronCountScaling': '1.0'},
+        'Acquisition': {'RefractiveIndex': '1.0', 'AcquisitionMode': 'Mode3D' if last_frame > 0 else 'Mode2D'},
+        'MetaInfo': {'Comment': comment},
+        'Image': {'SizePixel': size_pixel, 'SizeReal': {'SizeX': str(range_x), 'SizeZ': str(range_z)}},
+        'DataFiles': {'DataFile': [attrs for attrs, _ in data_files]}}}
+
+    with zipfile.ZipFile(filename, 'w', compression=compression) as zf:
+        zf.writestr('Header.xml', xmltodict.unparse(header, pretty=True))
+        for attrs, data in data_files:
+            zf.writestr(attrs['#text'], data)
+    return filename
@@ -15,20 +15,16 @@
 from OCT_reader import *
 
 def get_OCTSpectralAll(handle):
-    #
-    spec_names = get_OCTDataFileProps(handle, data_name='Spectral', prop='#text') # get all Spectral file data
-
-    spec3d = []
-    for sn in spec_names:
-        print(sn)
-        spec, apo_data = get_OCTSpectralRawFrame(handle, spec_name = sn)
-        spec3d.append(spec)
+    # The OCTVolume reads the Spectral data only if indexed, e.g. spec3d[0] or spec3d[10:20, :, 100:200].
+    # All data are read into one array with np.asarray(spec3d) or spec3d[:].
+    spec3d = OCTVolume(handle)
+    print(spec3d.names)
 
     return spec3d
 
 handle = unzip_OCTFile('test.oct') # see OCT_reader_demo.py to retrieve test.oct
 
-spec3d = np.array(get_OCTSpectralAll(handle))
+spec3d = np.asarray(get_OCTSpectralAll(handle))
 
 print(spec3d.shape)
 
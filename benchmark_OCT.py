@@ -0,0 +1,175 @@
+"""
+Benchmarks for reading and processing OCT files.
+
+Usage:
+python benchmark_OCT.py suite --sizes 256x512x8 512x1024x64 --json results.json
+python benchmark_OCT.py reconstruct <fname>.oct --workers 1 2 4 8
+python benchmark_OCT.py import --max-seconds 0.5
+
+suite writes synthetic OCT files (see OCT_synthetic) of each size XxZxY, stored and deflated,
+and reports MB/s and frames/s for unzip, header parse, frame decode, reconstruction and conversion.
+reconstruct reports the frames/s of reconstruct_volume for each number of workers.
+import reports the time to import each module in a new process and fails if
+a module takes longer than --max-seconds or imports matplotlib or scipy.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+def benchmark_reconstruct_volume(handle, worker_counts=(1, 2, 4), repeat=3):
+    """
+    Measure the throughput of reconstruct_volume in frames/s for each number of workers.
+    The best of repeat runs is reported.
+    """
+    from OCT_core import OCTVolume, get_OCTRealData
+    from OCT_processing import get_OCTResamplingPlan, get_OCTBackground, reconstruct_volume
+    num_frames = OCTVolume(handle).shape[0]
+    plan = get_OCTResamplingPlan(get_OCTRealData(handle, 'data\\Chirp.data'))
+    dc = get_OCTBackground(handle)
+    results = {}
+    for workers in worker_counts:
+        best = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            reconstruct_volume(handle, workers=workers, plan=plan, dc=dc)
+            best = min(best, time.perf_counter() - t0)
+        results[workers] = num_frames / best
+        print('workers: {:3d}  frames/s: {:10.1f}  speedup: {:5.2f}'.format(
+            workers, results[workers], results[workers] / results[worker_counts[0]]))
+    return results
+
+def benchmark_import(modules=('OCT_core', 'OCT_converter', 'OCT_processing'), repeat=5):
+    """
+    Measure the time to import each module in a new Python process, as paid by every worker process.
+    The best of repeat runs is reported with the heavy modules that were imported as a side effect.
+    """
+    code = ('import sys, time, json; t0 = time.perf_counter(); import {}; t1 = time.perf_counter(); '
+            'print(json.dumps([t1 - t0, [m for m in ("matplotlib", "scipy") if m in sys.modules]]))')
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules:
+        best = float('inf')
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, '-c', code.format(module)], cwd=here,
+                                 check=True, capture_output=True, text=True).stdout
+            seconds, heavy = json.loads(out.splitlines()[-1])
+            best = min(best, seconds)
+        results[module] = {'seconds': best, 'heavy_modules': heavy}
+        print('{:20s} import: {:7.3f} s  heavy modules: {}'.format(module, best, ', '.join(heavy) or '-'))
+    return results
+
+def run_timed(fun, repeat=1):
+    """
+    Return the best time of repeat calls of fun().
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fun()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def benchmark_suite(sizes=((256, 512, 8), (512, 1024, 32)), compressions=('stored', 'deflated'), repeat=3, workdir=None):
+    """
+    Measure the throughput of each processing stage for synthetic OCT files of each size (size_x, size_z, size_y).
+    All files, the extraction cache, and the outputs are kept in workdir (default a new temp folder).
+    Returns a list of dicts with 'stage', 'size', 'compression', 'seconds', 'MB/s', and 'frames/s'.
+    """
+    import xmltodict
+    import OCT_core
+    import OCT_converter
+    import OCT_processing
+    import OCT_synthetic
+    compression_types = {'stored': zipfile.ZIP_STORED, 'deflated': zipfile.ZIP_DEFLATED}
+    results = []
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        # keep the extraction cache and the resampling plans in tmpdir
+        tempdir_orig, tempfile.tempdir = tempfile.tempdir, tmpdir
+        try:
+            for size_x, size_z, size_y in sizes:
+                for compression in compressions:
+                    filename = os.path.join(tmpdir, 'synthetic_{}x{}x{}_{}.oct'.format(size_x, size_z, size_y, compression))
+                    OCT_synthetic.write_synthetic_OCTFile(filename, size_x, size_z, size_y,
+                                                          compression=compression_types[compression])
+                    handle = OCT_core.open_OCTFile(filename)
+                    vol = OCT_core.OCTVolume(handle, cache_bytes=0)
+                    data_bytes = sum(zinfo.file_size for zinfo in handle['zipfile'].infolist())
+                    header_xml = handle['zipfile'].read('Header.xml')
+                    chirp = OCT_core.get_OCTRealData(handle, 'data\\Chirp.data')
+                    plan = OCT_processing.get_OCTResamplingPlan(chirp)
+                    dc = OCT_processing.get_OCTBackground(handle)
+                    frames = vol[:min(8, vol.shape[0])]
+
+                    def unzip():
+                        OCT_core.purge_OCTCache()
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            OCT_core.unzip_OCTFile(filename)
+                    def decode():
+                        for y in range(vol.shape[0]):
+                            vol.get_frame(y)
+                    def convert():
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            OCT_converter.OCTtoNPYstream(filename)
+
+                    stages = [('unzip', unzip, data_bytes, vol.shape[0]),
+                              ('header parse', lambda: OCT_core.compile_OCTHeader(xmltodict.parse(header_xml)), len(header_xml), 0),
+                              ('frame decode', decode, vol.nbytes, vol.shape[0]),
+                              ('reconstruct', lambda: OCT_processing.reconstruct_OCTFrames(plan, frames, dc=dc), frames.nbytes, len(frames)),
+                              ('convert', convert, data_bytes, vol.shape[0])]
+                    for stage, fun, num_bytes, num_frames in stages:
+                        seconds = run_timed(fun, repeat)
+                        results.append({'stage': stage, 'size': [size_x, size_z, size_y], 'compression': compression,
+                                        'seconds': seconds, 'MB/s': num_bytes / seconds / 1e6,
+                                        'frames/s': num_frames / seconds if num_frames else None})
+                        print('{:>16s} {:9s} {:>13s} {:10.3f} ms {:10.1f} MB/s {:>10s} frames/s'.format(
+                            '{}x{}x{}'.format(size_x, size_z, size_y), compression, stage, seconds * 1e3,
+                            results[-1]['MB/s'], '-' if not num_frames else '{:.1f}'.format(results[-1]['frames/s'])))
+                    OCT_core.close_OCTFile(handle)
+        finally:
+            tempfile.tempdir = tempdir_orig
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    parser_suite = subparsers.add_parser('suite')
+    parser_suite.add_argument('--sizes', nargs='+', default=['256x512x8', '512x1024x32'], help='XxZxY')
+    parser_suite.add_argument('--compression', nargs='+', default=['stored', 'deflated'], choices=['stored', 'deflated'])
+    parser_suite.add_argument('--repeat', type=int, default=3)
+    parser_suite.add_argument('--json', default=None, help='write the results to this file')
+    parser_rec = subparsers.add_parser('reconstruct')
+    parser_rec.add_argument('filename')
+    parser_rec.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()])
+    parser_rec.add_argument('--repeat', type=int, default=3)
+    parser_imp = subparsers.add_parser('import')
+    parser_imp.add_argument('--modules', nargs='+', default=['OCT_core', 'OCT_converter', 'OCT_processing'])
+    parser_imp.add_argument('--repeat', type=int, default=5)
+    parser_imp.add_argument('--max-seconds', type=float, default=None)
+    args = parser.parse_args()
+
+    if args.benchmark == 'suite':
+        sizes = [tuple(int(n) for n in size.split('x')) for size in args.sizes]
+        results = benchmark_suite(sizes, args.compression, repeat=args.repeat)
+        if args.json:
+            with open(args.json, 'w') as fid:
+                json.dump(results, fid, indent=1)
+    elif args.benchmark == 'reconstruct':
+        from OCT_core import open_OCTFile, close_OCTFile
+        handle = open_OCTFile(args.filename)
+        try:
+            benchmark_reconstruct_volume(handle, worker_counts=sorted(set(args.workers)), repeat=args.repeat)
+        finally:
+            close_OCTFile(handle)
+    elif args.benchmark == 'import':
+        results = benchmark_import(args.modules, repeat=args.repeat)
+        failed = [m for m, r in results.items() if r['heavy_modules']
+                  or (args.max_seconds is not None and r['seconds'] > args.max_seconds)]
+        if failed:
+            sys.exit('Import regression in: {}'.format(', '.join(failed)))
@@ -15,9 +15,13 @@ function test_OCT_convert()
     pdata = (squeeze(Spectral(1,1000,:)));
     figure('name','Raw spectrum');plot(pdata)
 
-    % Get the mean of the apodisation data if it was stored as a region in Spectral.
-    % The variable Spectral_apo will be available.
-    mdata = (squeeze(mean(Spectral_apo(1,:,:))))';
+    % Background is the mean of all apodisation lines of the file.
+    % Older files only have the apodisation data of each B-frame in Spectral_apo.
+    if exist('Background', 'var')
+        mdata = Background(:)';
+    else
+        mdata = (squeeze(mean(Spectral_apo(1,:,:))))';
+    end
 
     % Get B-frame (1)
     spec = single(squeeze(Spectral(1,:,:)));
@@ -3,9 +3,8 @@ import matplotlib.pyplot as pp
 from mpl_toolkits.axes_grid1 import ImageGrid, make_axes_locatable # for scaling colorbar
 import numpy as np
 from scipy.io import loadmat
-from scipy.interpolate import interp1d
-from scipy.fftpack import fft, ifft
 import json
+from OCT_processing import get_OCTResamplingPlan, reconstruct_OCTFrames
 
 def test_OCT_converter():
     # This function demonstrates how to load the mat 'test.mat' file generated by the OCT_converter.py.
@@ -33,29 +32,24 @@ def test_OCT_converter():
     pp.figure(num = 'Raw spectrum')
     pp.plot(pdata)
 
-    apo_spec = data_dict['Spectral_apo'][0]
-    mdata = np.mean(apo_spec,axis=0)
-
-    spec_xs = spec.shape[0]
-    spec_zs = spec.shape[1]
+    # Background is the mean of all apodization lines of the file; older mat-files only have Spectral_apo
+    mdata = data_dict['Background'][0] if 'Background' in data_dict else np.mean(data_dict['Spectral_apo'][0], axis=0)
 
     # remove DC
-    spec = spec - mdata
     pp.figure(num = 'DC removed spectrum')
-    pp.plot(spec[SizeX//2,:])
+    pp.plot(spec[SizeX//2,:] - mdata)
 
-    # linearize k - space
-    k_lin = interp1d(x=Chirp, y=spec.T, axis=0)
-    spec_lin = k_lin(np.arange(0,spec_zs))
+    # linearize k - space; the plan is computed once for the Chirp and cached on disk
+    plan = get_OCTResamplingPlan(Chirp)
 
-    # ifft --> z - space
-    spec_fft = np.log10(np.abs(ifft(spec_lin, axis=0)))
+    # remove DC, linearize and fft --> z - space; returns [x, z] for positive z only
+    spec_fft = reconstruct_OCTFrames(plan, spec, dc=mdata).T
     # fig, ax = pp.subplots(1,num='Intensity Image')
     fig = pp.figure(num='Intensity Image')
     rangeX = np.float(Header['DataFileDict']['Spectral0']['RangeX'])
     rangeZ = np.float(Header['DataFileDict']['Spectral0']['RangeZ'])
     grid = ImageGrid(fig, 111, nrows_ncols=(1, 1), axes_pad=0.1, cbar_mode='single')
-    imax = grid[0].imshow(spec_fft[1:spec_zs//2,:], cmap='Greys_r',vmin=-1.5,vmax=-0.5,extent=(0,rangeX,rangeZ,0))
+    imax = grid[0].imshow(spec_fft[1:,:], cmap='Greys_r',vmin=-1.5,vmax=-0.5,extent=(0,rangeX,rangeZ,0))
     grid[0].set_xlabel('X (mm)')
     grid[0].set_ylabel('Z (mm)')
     cax = grid.cbar_axes[0]
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from OCT_core import OCTVolume, close_OCTFile, get_OCTDaskArray, get_OCTRealData, open_OCTFile
+from OCT_instrument import measure_allocations
+from OCT_processing import (OCTProcessor, get_OCTBackground, get_OCTResamplingPlan, reconstruct_OCTFrames,
+                            reconstruct_dask, reconstruct_volume)
+from OCT_synthetic import get_synthetic_Chirp, get_synthetic_Spectra, write_synthetic_OCTFile
+
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+def test_OCTProcessor(tmp_path, precision):
+    # OCTProcessor.process must reconstruct the same image as reconstruct_OCTFrames
+    # and allocate no arrays per frame, only a few Python objects.
+    chirp = get_synthetic_Chirp(512)
+    plan = get_OCTResamplingPlan(chirp, cache_dir=str(tmp_path))
+    frame = get_synthetic_Spectra(chirp, size_x=128)
+    dc = get_synthetic_Spectra(chirp, size_x=16, apo=True).mean(axis=0)
+
+    processor = OCTProcessor(plan, frame.shape, dc=dc, precision=precision)
+    image = np.empty(processor.out_shape, dtype=precision)
+    processor.process(frame, out=image)
+    expected = reconstruct_OCTFrames(plan, frame, dc=dc, precision=precision)
+    assert image.dtype == expected.dtype
+    np.testing.assert_allclose(image, expected, rtol=1e-5 if precision == 'float32' else 1e-12)
+
+    # a frame is 128 * 512 * 8 bytes = 512 kB in float64
+    assert measure_allocations(processor.process, frame, out=image) < 16 * 2**10
+
+def test_OCTDaskArray(tmp_path):
+    # the dask array and its reconstruction must equal OCTVolume and reconstruct_volume
+    pytest.importorskip('dask')
+    filename = write_synthetic_OCTFile(str(tmp_path / 'synthetic.oct'), size_x=64, size_z=256, size_y=5)
+    handle = open_OCTFile(filename)
+    try:
+        volume = get_OCTDaskArray(handle)
+        np.testing.assert_array_equal(volume.compute(scheduler='synchronous'), OCTVolume(handle)[:])
+
+        plan = get_OCTResamplingPlan(get_OCTRealData(handle, 'data\\Chirp.data'), cache_dir=str(tmp_path))
+        dc = get_OCTBackground(handle)
+        images = reconstruct_dask(volume, plan, dc=dc).compute(scheduler='synchronous')
+        np.testing.assert_allclose(images, reconstruct_volume(handle, workers=1, plan=plan, dc=dc), rtol=1e-12)
+    finally:
+        close_OCTFile(handle)